@@ -0,0 +1,184 @@
+"""
+Defines a packed, read-only content archive and the datastore reading it.
+
+An archive is a single file holding every file of a :class:`GameDatastore`
+tree, so that opening the content is one open and one mmap instead of a
+syscall per file. The layout is::
+
+    MAGIC  (8 bytes)
+    length of the index (8 bytes, little-endian)
+    index  (JSON, UTF-8)
+    contents of the files, back to back
+
+The index is an object with the root `name` and a list of `entries`, each
+``[parent, key, type, format, offset, length]``, where `parent` is the
+dotted path of the containing datastore (empty for the root) and offsets
+are relative to the end of the index. Sub-datastores are entries with a
+type of null.
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+import importlib
+
+import archon.datahandlers
+import archon.datastore
+
+MAGIC = b'ARCHON\x00\x01'
+HEADER = struct.Struct('<8sQ')
+
+
+class ArchiveDatastore(archon.datastore.GameDatastore):
+    """
+    A read-only datastore over a memory-mapped archive.
+
+    The index is read when the root is created; the contents of an entry
+    are decoded from the mapping when its thunk is evaluated. Writable
+    datastores (such as a directory for save games) can be mounted into
+    the tree with :meth:`add`; :meth:`create` and :meth:`save` with
+    `immediately` raise an error on the archive itself.
+
+    The root is created with the filename of the archive; sub-datastores
+    are created by the root with their name and parent.
+    """
+
+    WATCHABLE = False
+
+    def __init__(self, path, parent=None, maxLoaded=None):
+        self._setup(parent, maxLoaded)
+        if parent is None:
+            self._filename = os.path.abspath(path)
+            with open(self._filename, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, length = HEADER.unpack_from(self._map)
+            if magic != MAGIC:
+                raise ValueError(self._filename + ' is not an archive')
+            self._base = HEADER.size + length
+            index = json.loads(
+                self._map[HEADER.size:self._base].decode('utf-8'))
+            self._name = index['name']
+            self._path = ''
+            self._entries = {}
+            for location, key, objtype, format, offset, size in (
+                index['entries']):
+                self._entries.setdefault(location, {})[key] = (
+                    objtype, format, offset, size)
+        else:
+            self._name = path
+            self._path = '.'.join(filter(None, [parent._path, path]))
+        root = self.root
+        for key, (objtype, format, _, _) in root._entries.get(
+            self._path, {}).items():
+            if objtype is None:
+                self.add(key, self.__class__(key, self))
+            elif archon.datahandlers.dataloader.contains(objtype):
+                self.add(key, archon.datastore.DataThunk(
+                    self, key, None, key + format))
+
+    def _entry(self, key, format):
+        entry = self.root._entries.get(self._path, {}).get(key)
+        if entry is None or entry[0] is None or entry[1] != format:
+            raise IOError('No such key {} (format {}) in {}'.format(
+                    key, format, self.name))
+        return entry
+
+    def create(self, key):
+        raise IOError('Archive {} is read-only'.format(self.fullName))
+
+    def save(self, key, data=None, immediately=False):
+        """Mark the key for saving; archives cannot be written to."""
+        if immediately:
+            raise IOError('Archive {} is read-only'.format(self.fullName))
+        super().save(key, data)
+
+    def raw(self, key, format=None):
+        """Returns the raw dict object stored in the archive.
+
+        If `key` is a filename, pass in a format of `None`. Else, `format`
+        should be the file extension (with period) it was packed with."""
+        if not format:
+            key, format = os.path.splitext(key)
+        _, _, offset, size = self._entry(key, format)
+        if not archon.datahandlers.dataparser.contains(format):
+            raise ValueError('Format {} unsupported (key {} in {})'.format(
+                    format, key, self.name))
+        root = self.root
+        start = root._base + offset
+        data = archon.datahandlers.dataparser.get(format)(
+            root._map[start:start + size].decode('utf-8'))
+        if not data:
+            raise ValueError('Error loading data from {}.{}'.format(
+                    self.fullName, key))
+        return key, data
+
+    def header(self, key, format=None):
+        """Returns the type of the object stored under `key`."""
+        if not format:
+            key, format = os.path.splitext(key)
+        return key, self._entry(key, format)[0]
+
+    def close(self):
+        """Unmap the archive."""
+        self._map.close()
+
+
+def pack(path, filename, exclude=()):
+    """
+    Pack the :class:`GameDatastore` directory `path` into an archive.
+
+    Only files that the directory datastore would load are packed, and
+    top-level entries named in `exclude` (such as save games) are skipped.
+    """
+    source = archon.datastore.GameDatastore(path, lazy=True)
+    entries = []
+    contents = []
+    offset = 0
+    stack = [('', source)]
+    while stack:
+        prefix, ds = stack.pop()
+        for key, item in sorted(ds.thunks.items()):
+            if not prefix and key in exclude:
+                continue
+            if isinstance(item, archon.datastore.GameDatastore):
+                entries.append([prefix, key, None, None, 0, 0])
+                stack.append(('.'.join(filter(None, [prefix, key])), item))
+            elif isinstance(item, archon.datastore.DataThunk):
+                _, objtype = ds.header(item.filename)
+                with open(os.path.join(ds._path, item.filename), 'rb') as f:
+                    data = f.read()
+                entries.append([prefix, key, objtype,
+                                os.path.splitext(item.filename)[1],
+                                offset, len(data)])
+                contents.append(data)
+                offset += len(data)
+    index = json.dumps({'name': source.name,
+                        'entries': entries}).encode('utf-8')
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(index)))
+        f.write(index)
+        for data in contents:
+            f.write(data)
+    os.replace(filename + '.tmp', filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pack a content directory into an archive.')
+    parser.add_argument('-m', '--module', action='append', default=[],
+                        help='import a module that registers dataparsers')
+    parser.add_argument('-x', '--exclude', action='append', default=[],
+                        help='skip a top-level entry')
+    parser.add_argument('path')
+    parser.add_argument('archive')
+    args = parser.parse_args()
+    sys.path.insert(0, os.getcwd())
+    for module in args.module:
+        importlib.import_module(module)
+    pack(args.path, args.archive, args.exclude)
+
+if __name__ == '__main__':
+    main()
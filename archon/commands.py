@@ -6,6 +6,7 @@ import difflib
 import datetime
 import traceback
 import collections
+import concurrent.futures
 
 import archon.common
 import archon.objects
@@ -160,6 +161,7 @@ def equip(output, context, player, *args):
             if equip.get(slot):
                 inventory.add(equip[slot])
             equip[slot] = item
+            player.attributes.markDirty()
             inventory.remove(item)
         except KeyError:
             raise output.error('Could not find item.')
@@ -169,6 +171,7 @@ def equip(output, context, player, *args):
 def unequip(output, context, player, *args: findEquip):
     slot, item = args
     player.attributes.equip[slot] = None
+    player.attributes.markDirty()
     player.attributes.inventory.add(item)
     output.display('Unequipped item {} from {}'.format(
             item.friendlyName, slot))
@@ -294,26 +297,67 @@ def describe(output, context, player, *args):
             output.display(items[0][1].description)
 
 
+"""The futures of the files being written by the save command."""
+pendingSaves = []
+
+
+def failedSaves(wait=False):
+    """
+    Forget the saves that finished, returning the errors of those that
+    failed. If `wait` is true, wait for all of them first.
+    """
+    if wait:
+        concurrent.futures.wait(pendingSaves)
+    done = [future for future in pendingSaves if future.done()]
+    for future in done:
+        pendingSaves.remove(future)
+    return [future.exception() for future in done
+            if future.exception() is not None]
+
+
+def savesFailed(errors):
+    return "Could not save game: {}".format('; '.join(map(str, errors)))
+
+
 @command('quit', 'test.exit')
 def quit(output, context, player, *args):
+    errors = failedSaves(wait=True)
+    if errors:
+        raise output.error(savesFailed(errors))
     output.quit()
 
 
 @command('save')
 def save(output, context, player, *args):
-    data = player.save()
-    output.display(player.location)
-    player.entityCache.save('player', data, immediately=True)
+    # the files are written in the background; failures are reported by
+    # the next save, or by quit
+    errors = failedSaves()
+    if errors:
+        output.error(savesFailed(errors))
+    if player.attributes.dirty or 'player' not in player.entityCache:
+        data = player.save()
+        output.display(player.location)
+        player.attributes.markClean()
+        future = player.entityCache.save('player', data, immediately=True)
+        # so the player is written again if this fails
+        future.add_done_callback(lambda future: future.exception() and
+                                 player.attributes.markDirty())
+        pendingSaves.append(future)
+    allInstances = player.entityCache['instances']
+    # let instances nothing refers to any more be collected
+    report = allInstances.compact()
+    if output.permissions.get('debug', False):
+        output.display('Instances: {} held weakly, {} reclaimed'.format(
+                report['weak'], report['reclaimed']))
     instances = collections.defaultdict(dict)
-    for kind in player.entityCache['instances']:
-        ds = player.entityCache['instances'][kind]
-        for key in ds:
-            entity = ds[key]
+    for kind in allInstances:
+        for key, entity in allInstances[kind].items():
             proto = entity.prototype
-            patch = archon.common.Merge(proto.attributes.save(),
-                                        entity.attributes.save()).compared()
+            dirty = entity.attributes.dirty
+            patch = entity.attributes.diff(proto)
             if patch:
-                output.display("Saving entity " + entity.location)
+                if dirty:
+                    output.display("Saving entity " + entity.location)
                 instances[proto.location][entity.location] = patch
     instances = {
         "type": "metadata",
@@ -328,27 +372,36 @@ def save(output, context, player, *args):
         ds = stack.pop()
         for key, thunk in ds.thunks.items():
             if isinstance(thunk, archon.objects.Room):
-                _, originalData = ds.raw(key, format='.json')
-                merge = archon.common.Merge(originalData, thunk.save())
-                if merge.compared():
-                    output.display("Saving room " + thunk.location)
-                    patches[thunk.location] = merge.compared()
+                dirty = thunk.dirty
+                patch = thunk.diff()
+                if patch:
+                    if dirty:
+                        output.display("Saving room " + thunk.location)
+                    patches[thunk.location] = patch
+            elif getattr(thunk, 'patched', False):
+                # an unloaded thunk patched by a save game
+                merge = archon.common.Merge(thunk.source, thunk.data)
+                patches['.'.join([ds.fullName, key])] = merge.compared()
             elif isinstance(thunk, ds.__class__):
                 stack.append(thunk)
+    keys = {kind: allInstances[kind].keyCounter for kind in allInstances}
     patches = {
         "type": "metadata",
         "data": {
-            "savegame": patches
+            "savegame": patches,
+            "savegame_keys": keys
             }
         }
-    player.entityCache.save("patches", patches, immediately=True)
+    pendingSaves.append(
+        player.entityCache.save("patches", patches, immediately=True))
     gameVars = {
         "type": "data",
         "data": {
             "lastRoom": context.location
             }
         }
-    player.entityCache.save("gameVars", gameVars, immediately=True)
+    pendingSaves.append(
+        player.entityCache.save("gameVars", gameVars, immediately=True))
     output.display(
         "Save game created: {} objects saved".format(len(patches) + 1))
 
@@ -1,5 +1,6 @@
 import copy
 import blinker
+import collections
 
 
 def signal(name):
@@ -99,7 +100,7 @@ class Merge:
         self.dest = {}
         self.patch = patch
         self.sgroup = sgroup
-        if dest:
+        if dest is not None:  # an empty dict may still be patched in place
             if unsafe:
                 self.dest = dest
             else:
@@ -178,3 +179,158 @@ class Merge:
     @property
     def updated(self):
         return self.patch.get("update", {})
+
+
+def materialize(value):
+    """
+    Copy the dictionaries and lists in `value`, resolving copy-on-write
+    views; other objects (such as entities) are not copied.
+    """
+    if isinstance(value, collections.Mapping):
+        return {key: materialize(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [materialize(item) for item in value]
+    return value
+
+
+class CopyOnWriteDict(collections.MutableMapping):
+    """
+    A dictionary that shares another until it is changed.
+
+    Reads fall through to the `base` mapping, which must not be changed
+    through this object; writes and deletions are kept separately.
+    Dictionaries read from the base are returned as copy-on-write views
+    themselves, so changing a nested key only stores that key, and lists
+    are copied the first time they are read. :meth:`patch` gives the
+    changes as a :class:`Merge` patch against the base.
+
+    If `listener` is set, it is called as ``listener(path, value,
+    deleted)`` after a key of this dictionary or of a nested view is set
+    or deleted, where `path` is the tuple of keys leading to it. Changes
+    inside lists are not reported.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.listener = None
+        self._owner = None
+        self._changes = {}
+        self._deleted = set()
+        self._views = {}
+
+    def __getitem__(self, key):
+        if key in self._changes:
+            return self._changes[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        if key in self._views:
+            return self._views[key]
+        value = self.base[key]
+        if isinstance(value, collections.Mapping):
+            value = self._views[key] = CopyOnWriteDict(value)
+            value._owner = (self, key)
+        elif isinstance(value, list):
+            value = self._changes[key] = list(value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._detach(key)
+        self._deleted.discard(key)
+        self._changes[key] = value
+        self._notify((key,), value, False)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._detach(key)
+        self._changes.pop(key, None)
+        if key in self.base:
+            self._deleted.add(key)
+        self._notify((key,), None, True)
+
+    def _detach(self, key):
+        view = self._views.pop(key, None)
+        if view is not None:
+            view._owner = None
+
+    def _notify(self, path, value, deleted):
+        dictionary = self
+        while dictionary._owner is not None:
+            dictionary, key = dictionary._owner
+            path = (key,) + path
+        if dictionary.listener is not None:
+            dictionary.listener(path, value, deleted)
+
+    def __contains__(self, key):
+        if key in self._changes:
+            return True
+        return key not in self._deleted and key in self.base
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self._deleted:
+                yield key
+        for key in self._changes:
+            if key not in self.base:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.materialize())
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.materialize(), memo)
+
+    def copy(self):
+        """Return the contents as an ordinary dictionary (see
+        :func:`materialize`)."""
+        return self.materialize()
+
+    def materialize(self):
+        """Return the contents as an ordinary dictionary."""
+        return materialize(self)
+
+    def flatten(self):
+        """
+        Replace the base by an ordinary dictionary with the same contents.
+
+        Reads then no longer go through a chain of copy-on-write bases (as
+        with templates of templates), at the cost of a copy of the base.
+        Changes are still kept separately.
+        """
+        self._rebase(materialize(self.base))
+
+    def _rebase(self, base):
+        self.base = base
+        for key, view in self._views.items():
+            view._rebase(base[key])
+
+    def patch(self):
+        """Create the patch from the base to this dictionary.
+
+        Only the changed keys are visited."""
+        patch = {}
+        for key, value in self._changes.items():
+            if key in self.base and self.base[key] == value:
+                continue  # e.g. a list that was read but not changed
+            patch.setdefault('create', {})[key] = materialize(value)
+        for key, view in self._views.items():
+            subpatch = view.patch()
+            if subpatch:
+                patch.setdefault('update', {})[key] = subpatch
+        if self._deleted:
+            patch['delete'] = list(self._deleted)
+        return patch
+
+    def applyPatch(self, patch):
+        """Apply a :class:`Merge` patch (without a semigroup) in place."""
+        stack = [(self, patch)]
+        while stack:
+            dest, patch = stack.pop()
+            for key, value in patch.get('create', {}).items():
+                dest[key] = value
+            for key in patch.get('delete', []):
+                del dest[key]
+            for key, subpatch in patch.get('update', {}).items():
+                stack.append((dest[key], subpatch))
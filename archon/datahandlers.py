@@ -1,5 +1,10 @@
+import re
+import copy
 import json
+import hashlib
+import weakref
 import warnings
+import functools
 
 import archon.common
 import archon.objects
@@ -18,6 +23,64 @@ class dataparser(archon.common.denoter):
     functions = {}
 
 
+class dataheader(archon.common.denoter):
+    """Denotes a function that reads just enough of an open file to
+    determine the type of the data, returning None if it cannot."""
+    functions = {}
+
+
+"""The loaded objects shared between datastore trees, by content."""
+flyweights = weakref.WeakValueDictionary()
+
+
+def shared(references=lambda data: ()):
+    """
+    Share the immutable objects made by a dataloader across datastores.
+
+    Only datastore trees created with `shared` set take part, since the
+    digest costs every load. Objects are keyed by the full name of the
+    datastore, their key, a digest of their data and the objects at the
+    locations `references` returns for the data, so trees over the same
+    content (such as the sessions of a server) load each object once;
+    their own mutable state is unaffected. Mutable entities are never
+    shared. A shared entity keeps the datastore of the tree that loaded it
+    first as its `entityCache`, so its lookups resolve in that tree. An
+    object leaves the pool once no datastore refers to it.
+    """
+    def decorator(loader):
+        @functools.wraps(loader)
+        def _loader(key, data, cache):
+            if not cache.root.shared:
+                return loader(key, data, cache)
+            try:
+                digest = hashlib.sha1(json.dumps(
+                        data, sort_keys=True).encode('utf-8')).digest()
+                referenced = tuple(weakref.ref(cache.lookup(location))
+                                   for location in references(data))
+            except (TypeError, ValueError, KeyError):
+                return loader(key, data, cache)  # not shareable
+            shareKey = (cache.fullName, key, digest, referenced)
+            obj = flyweights.get(shareKey)
+            if obj is not None:
+                return obj
+            obj = loader(key, data, cache)
+            if isinstance(obj, archon.objects.Entity) and obj.mutable:
+                return obj
+            return flyweights.setdefault(shareKey, obj)
+        return _loader
+    return decorator
+
+
+def templateReferences(data):
+    """The locations of the templates an entity's data refers to."""
+    if 'template' in data:
+        yield data['template']
+    for value in data['attributes'].values():
+        if isinstance(value, dict) and 'template' in value and (
+            'data' in value):
+            yield value['template']
+
+
 class JSONDiff:
     def __init__(self):
         pass
@@ -40,11 +103,28 @@ def jsonType(contents):
         return None
 
 
+jsonHeaderRe = re.compile(r'\s*{\s*"type"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+
+@dataheader('.json')
+def jsonHeader(f):
+    """Read the type, if it is the first key of the file."""
+    match = jsonHeaderRe.match(f.read(256))
+    if match:
+        return json.loads(match.group(1))
+    return None
+
+
 @dataparser('.py')
 def pythonType(contents):
     return {"type": "script", "data": contents}
 
 
+@dataheader('.py')
+def pythonHeader(f):
+    return "script"
+
+
 @dataloader('metadata')
 def metadata(key, data, cache):
     for kind, data in data.items():
@@ -72,35 +152,66 @@ def metadata(key, data, cache):
                     proto = cache.lookup(proto)
                 for iname, patch in instances.items():
                     attributes = proto.attributes.copy()
-                    merge = archon.common.Merge(attributes, patch=patch)
-                    attributes = merge.patched()
+                    attributes.applyPatch(patch)
                     instance = proto.copy(name=iname, attributes=attributes)
+        elif kind == "savegame_keys":
+            # the instances datastore is saved next to this metadata
+            instances = cache['instances']
+            for instanceKind, count in data.items():
+                if instanceKind not in instances:
+                    instances.create(instanceKind)
+                instances[instanceKind].reserveKeys(count)
         else:
             warnings.warn(kind + " metadata kind not recognized!")
     return data
 
 
 @dataloader('entity')
+@shared(templateReferences)
 def entity(key, data, cache):
+    """
+    Loads an entity.
+
+    If the data has a `template`, the attributes override those of that
+    entity, which are looked up through it rather than copied. Attributes
+    with a `template` and `data` become entities the same way; the
+    `template` can be left out to override an entity the template has.
+
+    Immutable entities may be shared between datastores (see
+    :func:`shared`).
+    """
     kind = data['kind']
     attributes = data['attributes']
+    base = None
+    if 'template' in data:
+        try:
+            base = cache.lookup(data['template'])
+        except KeyError:
+            warnings.warn(
+                "Error templating {}".format(data['template']),
+                RuntimeWarning, stacklevel=2
+                )
     for attr, value in attributes.items():
-        if (isinstance(value, dict) and
-            'template' in value and 'data' in value):  # embedded template
+        if not (isinstance(value, dict) and 'data' in value):
+            continue
+        template = base.attributes.get(attr) if base is not None else None
+        if 'template' in value:  # embedded template
             try:
-                template = cache.lookup(value['template']).copy()
-                # deal with mutables, use templating mechanism
-                template.attributes.attributes.update(
-                    template.attributes.viaTemplate(value['data']))
-                # XXX this would be more resilient if it recursed into
-                # subvalues so that they could also be used as defaults
-                attributes[attr] = template
+                template = cache.lookup(value['template'])
             except KeyError:  # didn't find entity
                 warnings.warn(
                     "Error templating {}".format(value['template']),
                     RuntimeWarning, stacklevel=2
                     )
-    entity = archon.objects.Entity(key, kind, cache, data['attributes'])
+                continue
+        if isinstance(template, archon.objects.Entity):
+            attributes[attr] = archon.objects.Entity(
+                template.name, template.kind, cache,
+                template.attributes.viaTemplate(value['data']),
+                prototype=template)
+    if base is not None:
+        attributes = base.attributes.viaTemplate(attributes)
+    entity = archon.objects.Entity(key, kind, cache, attributes)
     return entity
 
 
@@ -117,7 +228,15 @@ def area(key, data, cache):
 @dataloader('room')
 def room(key, data, cache):
     description = data['describe']
-    room = archon.objects.Room(key, description, cache)
+    thunk = cache.thunks.get(key)
+    previous = getattr(thunk, 'previous', None)
+    if isinstance(previous, archon.objects.Room):
+        room = previous  # reload in place, so references stay valid
+        room.reset(description)
+    else:
+        room = archon.objects.Room(key, description, cache)
+    # keep the unpatched data to create save game patches from
+    room.source = copy.deepcopy(getattr(thunk, 'source', data))
 
     for name, val in data['attributes'].items():
         room.attributes[name] = val
@@ -166,6 +285,12 @@ def room(key, data, cache):
             room.addRoom(direction, troom)
         except KeyError:
             raise ValueError("Room {} not found!".format(target))
+
+    # a patched room differs from its source until the next save
+    if getattr(thunk, 'patched', False):
+        room.attributes.markDirty()
+    else:
+        room.attributes.markClean()
     return room
 
 
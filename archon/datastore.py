@@ -4,9 +4,16 @@ Defines the game database, a mapping from JSON to game objects.
 
 import os
 import json
+import time
 import types
+import atexit
+import threading
 import collections
+import weakref
+import warnings
+import concurrent.futures
 
+import archon.common
 import archon.objects
 import archon.datahandlers
 
@@ -14,22 +21,135 @@ import archon.datahandlers
 class DataThunk:
     """
     Represents an unloaded object.
+
+    If no data is given, it is read from `filename` in the datastore the
+    first time it is needed. If the thunk replaces an object that is being
+    reloaded, `previous` is that object.
     """
-    def __init__(self, ds, key, data):
+    def __init__(self, ds, key, data=None, filename=None):
         self.ds = ds
         self.key = key
-        self.data = data
+        self.filename = filename
+        self.patched = False
+        self.previous = None
+        self._data = data
+
+    @property
+    def data(self):
+        """The raw data of the object, parsed on first access."""
+        if self._data is None:
+            self._data = self.ds.raw(self.filename)[1]
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        if not self.patched:
+            self._source = self.data
+        self._data = value
+        self.patched = True
+
+    @property
+    def source(self):
+        """The data as read from disk, before any patches."""
+        return self._source if self.patched else self.data
 
     def __call__(self):
         # for code that checks with callable()
-        item = self.ds.load(self.key, self.data)
+        data = self.data
+        item = self.ds.load(self.key, data)
         self.ds._didLoad[self.key] = True
         self.ds._cache[self.key] = item
+        self.ds.root._loaded(self, data['type'], item)
         return item
 
     evaluate = __call__
 
 
+class SaveQueue:
+    """
+    Writes saved files on a background thread.
+
+    Saves of a file that is still waiting to be written are coalesced, so
+    only the latest text is written. Each batch is written to temporary
+    files, which are synced to disk and then renamed over the originals,
+    so a crash never leaves a half-written file.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._writing = 0
+        self._thread = None
+
+    def put(self, path, text):
+        """Queue `text` to be written to `path`, returning a future."""
+        future = concurrent.futures.Future()
+        with self._condition:
+            if path in self._pending:
+                self._pending[path][0] = text
+                self._pending[path][1].append(future)
+            else:
+                self._pending[path] = [text, [future]]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='SaveQueue',
+                                                daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            self._condition.notify_all()
+        return future
+
+    def flush(self):
+        """Block until everything queued so far is written."""
+        with self._condition:
+            while self._pending or self._writing:
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                batch, self._pending = (self._pending,
+                                        collections.OrderedDict())
+                self._writing += 1
+            try:
+                self._write(batch)
+            finally:
+                with self._condition:
+                    self._writing -= 1
+                    self._condition.notify_all()
+
+    def _write(self, batch):
+        written = []
+        for path, (text, futures) in batch.items():
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                written.append((path, futures))
+        # make the renames durable
+        for directory in {os.path.dirname(path) for path, _ in written}:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+            except OSError:
+                continue  # e.g. directories cannot be opened on Windows
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        for path, futures in written:
+            for future in futures:
+                future.set_result(path)
+
+
 # TODO possibly use super() as described
 # http://rhettinger.wordpress.com/2011/05/26/super-considered-super/ to
 # implement mixin classes for datastore storage and type (e.g. a file-based
@@ -67,28 +187,230 @@ class GameDatastore(Datastore):
     requests them. After loaded, the datastore will continue to hold on to
     the object. No changes made will be saved unless the save() method is
     called.
+
+    If `lazy` is true, the scan only reads enough of each file to learn its
+    type (see archon.datahandlers.dataheader); the file is parsed when its
+    thunk is evaluated.
+
+    If `manifest` is the path of a manifest file, the root datastore
+    remembers the type, size and modification time of every file there.
+    Later scans trust the manifest for files whose size and modification
+    time are unchanged, and directories whose modification time is
+    unchanged are not listed again. Implies `lazy`.
+
+    If `maxLoaded` is given, the root datastore keeps at most that many
+    loaded objects that can be read back from disk, evicting the least
+    recently used back to thunks. Only unpatched entities and data can be
+    evicted; mutable entities (including rooms and instances), scripts
+    (which register commands when run), metadata and anything marked with
+    save() stay loaded. Hit, miss and eviction counts are kept in
+    :attr:`statistics`.
+
+    Instances (entities with a prototype) that are unmodified can be held
+    weakly by :meth:`compact`, so that they are removed once nothing else
+    refers to them.
+
+    If `shared` is true, immutable entities loaded by the tree are shared
+    with other shared trees over the same content (see
+    :func:`archon.datahandlers.shared`).
+
+    If `executor` is a :class:`concurrent.futures.Executor`, directories
+    are listed and files are scanned (and parsed, unless lazy) in parallel
+    on it while the tree is built. With a process pool, any dataparsers
+    and dataheaders must also be registered in the worker processes.
     """
 
-    def __init__(self, path, parent=None):
+    MANIFEST_VERSION = 1
+    saveQueue = SaveQueue()
+    EVICTABLE_TYPES = ('entity', 'data')
+    WATCHABLE = True
+    shared = False
+    onReload = archon.common.signal('datastore.reload')
+
+    def __init__(self, path, parent=None, lazy=False, manifest=None,
+                 executor=None, maxLoaded=None, shared=False):
         self._path = os.path.abspath(path)
         self._name = os.path.basename(os.path.normpath(path))
         # normpath deals with trailing slash, basename gets directory name
-        self.parent = parent
+        self._setup(parent, maxLoaded, lazy or bool(manifest), shared)
+        self._manifest = manifest
+        # don't add myself - my parent takes care of it
+        previous = self._previousManifest()
+        scanned = self._prescanned()
+        if scanned is None:
+            self._scanned = self._prescan(previous, executor)
+            scanned = self._scanned.pop(self._path)
+        self._populate(*scanned)
+        self._scanned = None
+        if manifest and self.manifest() != previous:
+            self.writeManifest()
+
+    def _setup(self, parent, maxLoaded, lazy=True, shared=False):
+        """Initialize the state that does not depend on the storage.
+
+        Datastores over other storage call this instead of
+        :meth:`__init__`."""
         self._cache = {}
+        self._resolved = {}
+        self._parent = None
+        self.parent = parent
         self._didLoad = collections.defaultdict(lambda: False)
         self._shouldSave = set()
-        # don't add myself - my parent takes care of it
-        for fname in os.listdir(self._path):
-            fullpath = os.path.join(self._path, fname)
-            if os.path.isfile(fullpath):
-                key, data = self.raw(fname)
-                if data and archon.datahandlers.dataloader.contains(
-                    data['type']
-                    ):
-                    self.add(key, DataThunk(self, key, data))
-            elif os.path.isdir(fullpath):
-                child = self.__class__(fullpath, self)
-                self.add(child.name, child)
+        self._keyCounter = 0
+        self._dead = []
+        self.maxLoaded = maxLoaded
+        self.lazy = lazy
+        self.shared = shared
+        self.statistics = collections.Counter()
+        self._recent = collections.OrderedDict()
+        self._manifest = None
+        self._manifestFiles = {}
+        self._mtime = None
+        self._scanned = None
+
+    @property
+    def parent(self):
+        """The datastore containing this one, or None for the root."""
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        # the cached names, root and resolved paths of this subtree depend
+        # on the parent, so forget them
+        self._resolved.clear()
+        resolved = parent._resolved if parent is not None else {}
+        resolved.clear()
+        self._parent = parent
+        stack = [self]
+        while stack:
+            ds = stack.pop()
+            ds._fullName = ds._root = None
+            ds._resolved = resolved
+            stack.extend(child for child in ds._cache.values()
+                         if isinstance(child, GameDatastore))
+
+    def _previousManifest(self):
+        """The manifest entry from the last scan of this directory."""
+        if self.isRoot and self._manifest and os.path.isfile(self._manifest):
+            try:
+                with open(self._manifest) as f:
+                    manifest = json.load(f)
+            except ValueError:
+                return None
+            if manifest.get('version') == self.MANIFEST_VERSION:
+                return manifest['root']
+        return None
+
+    def _prescanned(self):
+        """Find the results for this directory from an ancestor's scan."""
+        ds = self.parent
+        while ds is not None:
+            if ds._scanned is not None and self._path in ds._scanned:
+                return ds._scanned.pop(self._path)
+            ds = ds.parent
+        return None
+
+    def _prescan(self, previous, executor=None):
+        """
+        Scan the directory tree without building any datastores.
+
+        Returns a dictionary of directory paths to (mtime, files,
+        subdirectories), where files are the results of
+        :func:`_scanFile`. If an executor is given, directory listings and
+        files are scanned in parallel.
+        """
+        stat = bool(self.root._manifest)
+        lazy = self.lazy
+        results = {}
+        if executor is None:
+            stack = [(self._path, previous)]
+            while stack:
+                path, previous = stack.pop()
+                mtime, fnames, dnames = _scanDirectory(path, previous, stat)
+                files = previous['files'] if previous else {}
+                results[path] = (mtime, [
+                    _scanFile(path, fname, lazy, stat, files.get(fname))
+                    for fname in fnames], dnames)
+                for dname in dnames:
+                    stack.append((os.path.join(path, dname),
+                                  previous['directories'].get(dname)
+                                  if previous else None))
+            return results
+        pending = {
+            executor.submit(_scanDirectory, self._path, previous, stat):
+                (self._path, previous)
+            }
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, previous = pending.pop(future)
+                mtime, fnames, dnames = future.result()
+                files = previous['files'] if previous else {}
+                results[path] = (mtime, [
+                    executor.submit(_scanFile, path, fname, lazy, stat,
+                                    files.get(fname))
+                    for fname in fnames], dnames)
+                for dname in dnames:
+                    subpath = os.path.join(path, dname)
+                    subprevious = (previous['directories'].get(dname)
+                                   if previous else None)
+                    future = executor.submit(_scanDirectory, subpath,
+                                             subprevious, stat)
+                    pending[future] = (subpath, subprevious)
+        return {path: (mtime, [f.result() for f in files], dnames)
+                for path, (mtime, files, dnames) in results.items()}
+
+    def _populate(self, mtime, files, dnames):
+        """Add thunks and child datastores for the scanned directory."""
+        self._mtime = mtime
+        for fname, key, objtype, data, entry in files:
+            if entry:
+                self._manifestFiles[fname] = entry
+            if archon.datahandlers.dataloader.contains(objtype):
+                self.add(key, DataThunk(self, key, data, fname))
+        for dname in dnames:
+            child = self.__class__(os.path.join(self._path, dname), self,
+                                   lazy=self.lazy)
+            self.add(child.name, child)
+
+    def manifest(self):
+        """Create the manifest entry describing this directory."""
+        return {
+            'mtime': self._mtime,
+            'files': dict(self._manifestFiles),
+            'directories': {
+                key: child.manifest() for key, child in self._cache.items()
+                if isinstance(child, GameDatastore)
+                }
+            }
+
+    def manifestEntries(self):
+        """Iterate through (dotted key, path, manifest entry) of files.
+
+        Keys and paths are relative to this datastore."""
+        stack = [('', self)]
+        while stack:
+            prefix, ds = stack.pop()
+            for fname, entry in ds._manifestFiles.items():
+                key = prefix + os.path.splitext(fname)[0]
+                yield key, os.path.relpath(os.path.join(ds._path, fname),
+                                           self._path), entry
+            for key, child in ds._cache.items():
+                if isinstance(child, GameDatastore):
+                    stack.append((prefix + key + '.', child))
+
+    def writeManifest(self):
+        """Write the manifest of the whole tree."""
+        root = self.root
+        if not root._manifest:
+            return
+        manifest = {'version': self.MANIFEST_VERSION,
+                    'root': root.manifest()}
+        temp = root._manifest + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp, root._manifest)
 
     def load(self, key, data):
         """
@@ -104,6 +426,25 @@ class GameDatastore(Datastore):
                 )
             return obj
 
+    def _loaded(self, thunk, objtype, item):
+        """Record that a thunk was loaded. Only called on the root."""
+        self.statistics['misses'] += 1
+        if self.maxLoaded is None or thunk.patched or not thunk.filename:
+            return
+        if objtype not in self.EVICTABLE_TYPES:
+            return
+        if isinstance(item, archon.objects.Entity) and (
+            item.mutable or item.prototype):
+            return
+        self._recent[thunk.ds, thunk.key] = (item, thunk.filename)
+        while len(self._recent) > self.maxLoaded:
+            (ds, key), (item, filename) = self._recent.popitem(last=False)
+            if key in ds._shouldSave or ds._cache.get(key) is not item:
+                continue  # pinned or replaced - stop tracking
+            ds._cache[key] = DataThunk(ds, key, None, filename)
+            ds._didLoad.pop(key, None)
+            self.statistics['evictions'] += 1
+
     def save(self, key, data=None, immediately=False):
         """
         Save the data to disk, or if the key exists, mark it for saving.
@@ -114,35 +455,150 @@ class GameDatastore(Datastore):
         specified; instead, it will be saved at the end of the datastore's
         lifetime. This method can also add a new object to the database at
         runtime.
+
+        If `immediately` is true, the data is serialized now and written by
+        :attr:`saveQueue` in the background; the returned
+        :class:`concurrent.futures.Future` completes once it is on disk.
+        Without data there is nothing to write, and the future is already
+        done.
         """
         self._shouldSave.add(key)
         if data:
             self.add(key, data)
+        if immediately and data is None:
+            future = concurrent.futures.Future()
+            future.set_result(None)
+            return future
         if immediately:
-            json.dump(data,
-                      open(os.path.join(self._path, key + '.json'), 'w'),
-                      indent=1,
-                      cls=EntityJSONEncoder)
+            text = json.dumps(data, indent=1, cls=EntityJSONEncoder)
+            return self.saveQueue.put(
+                os.path.join(self._path, key + '.json'), text)
+
+    def flush(self):
+        """Wait until all immediate saves so far are written to disk."""
+        self.saveQueue.flush()
+
+    def reload(self, key, filename=None):
+        """
+        Forget the object under `key` so it is read again from `filename`.
+
+        The object is replaced by an unloaded thunk, or removed if
+        `filename` is None. A thunk patched by a save game is patched
+        again. A loaded room keeps the entities added and removed and the
+        attributes changed since it was read (see :meth:`Room.changes`);
+        everything else comes from the new data. If a loaded object is
+        replaced or removed, :attr:`onReload` is sent with it as the sender
+        and with the datastore and key, so that whatever holds on to it can
+        refresh.
+        """
+        old = self._cache.get(key)
+        if filename is None:
+            if key in self._cache:
+                self.remove(key)
+        else:
+            thunk = DataThunk(self, key, None, filename)
+            if isinstance(old, DataThunk):
+                thunk.previous = old.previous
+                if old.patched:
+                    patch = archon.common.Merge(old.source,
+                                                old.data).compared()
+                    if patch:
+                        thunk.data = archon.common.Merge(
+                            thunk.data, patch=patch).patched()
+            elif not isinstance(old, Datastore):
+                thunk.previous = old
+                if (isinstance(old, archon.objects.Room) and
+                    old.source is not None):
+                    patch = old.changes()
+                    if patch:
+                        thunk.data = archon.common.Merge(
+                            thunk.data, patch=patch).patched()
+            self.root._recent.pop((self, key), None)
+            self._didLoad.pop(key, None)
+            self.add(key, thunk)
+        if old is not None and not isinstance(old, (DataThunk, Datastore)):
+            self.onReload.send(old, datastore=self, key=key)
+
+    def watch(self, interval=1.0):
+        """Create a :class:`Watcher` for this datastore and its children."""
+        return Watcher(self, interval)
 
     def add(self, key, item):
         """Add an item into the datastore."""
+        if key.isdigit() and int(key) >= self._keyCounter:
+            self._keyCounter = int(key) + 1
+        if (isinstance(item, Datastore) or
+            isinstance(self._cache.get(key), Datastore)):
+            self._resolved.clear()
         self._cache[key] = item
         if not isinstance(item, DataThunk):
             self._didLoad[key] = True  # Strict add
 
+    def update(self, items):
+        """Add several (key, item) pairs into the datastore at once."""
+        items = dict(items)
+        numeric = [int(key) for key in items if key.isdigit()]
+        if numeric:
+            self.reserveKeys(max(numeric) + 1)
+        if any(isinstance(item, Datastore) or
+               isinstance(self._cache.get(key), Datastore)
+               for key, item in items.items()):
+            self._resolved.clear()
+        self._cache.update(items)
+        self._didLoad.update((key, True) for key, item in items.items()
+                             if not isinstance(item, DataThunk))
+
     def remove(self, key):
         """Remove an item from the datastore."""
-        del self._cache[key]
+        if isinstance(self._cache.pop(key), Datastore):
+            self._resolved.clear()
+        self.root._recent.pop((self, key), None)
 
     def keys(self):
+        self._purge()
         return self._cache.keys()
 
+    def items(self):
+        """Iterate through (key, object), loading unloaded objects."""
+        for key in list(self):
+            try:
+                yield key, self[key]
+            except KeyError:
+                continue  # a weakly held object was collected meanwhile
+
+    def newKey(self):
+        """
+        Allocate a numeric key that is not in use.
+
+        Keys are allocated in increasing order and are greater than any
+        numeric key added so far, so removed keys are not reused.
+        """
+        key = self._keyCounter
+        self._keyCounter += 1
+        return str(key)
+
+    def newKeys(self, count):
+        """Allocate a block of `count` consecutive keys, as :meth:`newKey`
+        would."""
+        start = self._keyCounter
+        self._keyCounter += count
+        return [str(key) for key in range(start, self._keyCounter)]
+
+    @property
+    def keyCounter(self):
+        """The next key :meth:`newKey` will allocate."""
+        return self._keyCounter
+
+    def reserveKeys(self, count):
+        """Make sure :meth:`newKey` never allocates keys below `count`."""
+        self._keyCounter = max(self._keyCounter, count)
+
     def create(self, key):
         """Create a sub-datastore with the given name."""
         assert key not in self
         fullpath = os.path.join(self._path, key)
         os.mkdir(fullpath)
-        child = self.__class__(fullpath, self)
+        child = self.__class__(fullpath, self, lazy=self.lazy)
         self.add(child.name, child)
         return child
 
@@ -153,23 +609,17 @@ class GameDatastore(Datastore):
         should be a file extension (with period)."""
         if not format:
             key, format = os.path.splitext(key)
-        fullpath = os.path.join(self._path, key + format)
-        if os.path.isfile(fullpath):
-            if archon.datahandlers.dataparser.contains(format):
-                loader = archon.datahandlers.dataparser.get(format)
-                f = open(fullpath)
-                data = loader(f.read())
-                f.close()
-                if not data:
-                    raise ValueError('Error loading data from ' + fullpath)
-                return key, data
-            else:
-                raise ValueError(
-                    'Format {} unsupported (key {} in {})'.format(
-                        format, key, self.name))
-        else:
-            raise IOError('No such key {} (format {}) in {}'.format(
-                    key, format, self.name))
+        return key, _raw(self._path, key, format)
+
+    def header(self, key, format=None):
+        """Returns the type of the object stored under `key`.
+
+        Only as much of the file as the format's dataheader needs is read;
+        if there is no dataheader, or it cannot tell, this falls back to
+        :meth:`raw`. `key` and `format` are as in :meth:`raw`."""
+        if not format:
+            key, format = os.path.splitext(key)
+        return key, _header(self._path, key, format)
 
     @property
     def name(self):
@@ -179,24 +629,26 @@ class GameDatastore(Datastore):
     @property
     def fullName(self):
         """The full name: the name of the parent with my name."""
-        names = [self.name]
-        current = self
-        while current.parent:
-            names.append(current.parent.name)
-            current = current.parent
-        return '.'.join(reversed(names))
+        if self._fullName is None:
+            if self.parent is not None:
+                self._fullName = '.'.join([self.parent.fullName, self.name])
+            else:
+                self._fullName = self.name
+        return self._fullName
 
     @property
     def root(self):
         """The root, which contains all other datastores."""
-        if self.parent:
-            return self.parent.root
-        else:
-            return self
+        if self._root is None:
+            if self.parent is not None:
+                self._root = self.parent.root
+            else:
+                self._root = self
+        return self._root
 
     @property
     def isRoot(self):
-        return not self.parent
+        return self.parent is None
 
     @property
     def thunks(self):
@@ -210,11 +662,88 @@ class GameDatastore(Datastore):
             return self.root[key]
 
     def __iter__(self):
+        self._purge()
         for key in self._cache:
             yield key
 
+    def compact(self):
+        """
+        Hold unmodified instances in this datastore and its children weakly.
+
+        Loaded entities with a prototype whose attributes do not differ
+        from the prototype's are held weakly, so they are removed once
+        nothing else (such as a room or an inventory) refers to them.
+        Weakly held instances that changed since are pinned (held strongly)
+        again, as are keys marked with :meth:`save`.
+
+        Returns a :class:`collections.Counter` with the number of instances
+        `weakened` and `pinned` by this call, `reclaimed` since the last
+        call, and still held `weak`.
+        """
+        report = collections.Counter()
+        stack = [self]
+        while stack:
+            ds = stack.pop()
+            ds._purge()
+            report['reclaimed'] += ds.statistics.pop('reclaimed', 0)
+            for key, item in list(ds._cache.items()):
+                if isinstance(item, Datastore):
+                    stack.append(item)
+                    continue
+                weak = isinstance(item, weakref.ref)
+                if weak:
+                    item = item()
+                    if item is None:
+                        continue
+                if not (isinstance(item, archon.objects.Entity) and
+                        item.prototype is not None):
+                    continue
+                pinned = (key in ds._shouldSave or
+                          getattr(item.attributes, 'modified', True))
+                if pinned and weak:
+                    ds._cache[key] = item
+                    report['pinned'] += 1
+                elif not pinned:
+                    if not weak:
+                        ds._cache[key] = weakref.ref(item, ds._collected(key))
+                        report['weakened'] += 1
+                    report['weak'] += 1
+        return report
+
+    def _collected(self, key):
+        # the cyclic garbage collector may run at any time, so the entry is
+        # only removed when the datastore is next used
+        def callback(ref):
+            self._dead.append((key, ref))
+        return callback
+
+    def _purge(self):
+        while self._dead:
+            key, ref = self._dead.pop()
+            if self._cache.get(key) is ref:
+                del self._cache[key]
+                self._didLoad.pop(key, None)
+                self.statistics['reclaimed'] += 1
+
     def datastoreFor(self, key):
-        """Find the containing datastore of the given key."""
+        """Find the containing datastore of the given key.
+
+        Returns the last part of the key and the datastore. The datastore
+        found for each prefix of keys (the key without its last part) is
+        remembered until a datastore is added to or removed from the tree,
+        so the cache grows with the directories, not the keys."""
+        if '.' not in key:
+            return key, self
+        prefix, _, last = key.rpartition('.')
+        try:
+            return last, self._resolved[self, prefix]
+        except KeyError:
+            pass
+        last, ds = self._datastoreFor(key)
+        self._resolved[self, prefix] = ds
+        return last, ds
+
+    def _datastoreFor(self, key):
         if self.isRoot and key.split('.', 1)[0] == self.name:
             return self.datastoreFor(key.split('.', 1)[1])
         elif key.startswith('.'):  # absolute lookup
@@ -234,30 +763,284 @@ class GameDatastore(Datastore):
         return ds._cache[key]
 
     def fullPathFor(self, key):
-        return '.'.join([self.datastoreFor(key).fullName,
-                         key.split('.')[-1]])
+        """The absolute key of the given key."""
+        key, ds = self.datastoreFor(key)
+        return '.'.join([ds.fullName, key])
 
     def __getitem__(self, key):
-        thunk = self.thunkFor(key)
+        key, ds = self.datastoreFor(key)
+        if key not in ds._cache:
+            raise KeyError(key)
+        thunk = ds._cache[key]
         if isinstance(thunk, DataThunk):
             thunk = thunk.evaluate()
+        elif not isinstance(thunk, Datastore):
+            if isinstance(thunk, weakref.ref):
+                thunk = thunk()
+                if thunk is None:  # collected, but not purged yet
+                    ds._purge()
+                    raise KeyError(key)
+            root = self.root
+            root.statistics['hits'] += 1
+            if (ds, key) in root._recent:
+                root._recent.move_to_end((ds, key))
         return thunk
 
     def __contains__(self, key):
-        if '.' in key:
-            key, subkey = key.split('.', 1)
-            return key in self._cache and subkey in self[key]
-        else:
+        if '.' not in key:
+            self._purge()
             return key in self._cache
+        try:
+            key, ds = self.datastoreFor(key)
+        except (KeyError, AttributeError):
+            return False
+        ds._purge()
+        return key in ds._cache
 
     def __bool__(self):
+        self._purge()
         return bool(self._cache)
 
 
+class Watcher:
+    """
+    Polls the directories of a datastore tree for changed files.
+
+    Each poll compares the modification times of the directories (to find
+    added and removed files) and of the files (to find changed ones) with
+    the previous poll. Changed files are reloaded with
+    :meth:`GameDatastore.reload` and added or removed files and directories
+    are added to or removed from their datastore; nothing else in the tree
+    is touched. Keys marked with :meth:`GameDatastore.save` belong to the
+    game and are never reloaded.
+
+    Datastores that are not directories (such as archives) are skipped,
+    but directories mounted in them are watched.
+    """
+    def __init__(self, ds, interval=1.0):
+        self.ds = ds
+        self.interval = interval
+        self._lastPoll = time.monotonic()
+        self._stats = {}
+        for child in self._datastores(ds):
+            self._snapshot(child)
+
+    def _datastores(self, ds):
+        stack = [ds]
+        while stack:
+            ds = stack.pop()
+            if ds.WATCHABLE:
+                yield ds
+            stack.extend(child for child in ds.thunks.values()
+                         if isinstance(child, GameDatastore))
+
+    def _snapshot(self, ds):
+        try:
+            mtime = os.stat(ds._path).st_mtime_ns
+            self._stats[ds] = (mtime, _listFiles(ds._path)[0])
+        except OSError:
+            pass
+
+    def poll(self, force=False):
+        """
+        Reload whatever changed since the last poll.
+
+        Unless `force` is true, nothing is checked if less than `interval`
+        seconds passed since the last poll. Returns the full names of the
+        keys that were reloaded, added or removed.
+        """
+        now = time.monotonic()
+        if not force and now - self._lastPoll < self.interval:
+            return []
+        self._lastPoll = now
+        changed = []
+        datastores = list(self._datastores(self.ds))
+        for ds in datastores:
+            if ds in self._stats:
+                changed.extend(self._poll(ds))
+            else:
+                self._snapshot(ds)  # e.g. created by the game
+        for ds in self._stats.keys() - set(self._datastores(self.ds)):
+            del self._stats[ds]
+        if changed:
+            self.ds.writeManifest()
+        return changed
+
+    def _poll(self, ds):
+        mtime, files = self._stats[ds]
+        try:
+            newMtime = os.stat(ds._path).st_mtime_ns
+        except OSError:
+            return []  # removed; the parent removes the datastore
+        if newMtime != mtime:
+            listing, dnames = _listFiles(ds._path)
+        else:
+            listing, dnames = {}, None
+            for fname in files:
+                try:
+                    st = os.stat(os.path.join(ds._path, fname))
+                except OSError:
+                    continue
+                listing[fname] = (st.st_size, st.st_mtime_ns)
+        self._stats[ds] = (newMtime, listing)
+        changed = []
+        stat = bool(ds.root._manifest)
+        for fname in files.keys() - listing.keys():
+            ds._manifestFiles.pop(fname, None)
+            key = os.path.splitext(fname)[0]
+            if (key in ds._shouldSave or key not in ds.thunks or
+                isinstance(ds.thunks[key], Datastore)):
+                continue
+            ds.reload(key)
+            changed.append('.'.join([ds.fullName, key]))
+        for fname, st in listing.items():
+            if files.get(fname) == st:
+                continue
+            key = os.path.splitext(fname)[0]
+            if key in ds._shouldSave:
+                continue
+            try:
+                _, _, objtype, _, entry = _scanFile(ds._path, fname, True,
+                                                    stat)
+            except (IOError, ValueError) as e:
+                warnings.warn('Could not reload {}: {}'.format(
+                        os.path.join(ds._path, fname), e), RuntimeWarning)
+                continue
+            if entry:
+                ds._manifestFiles[fname] = entry
+            if archon.datahandlers.dataloader.contains(objtype):
+                ds.reload(key, fname)
+            elif key in ds.thunks:
+                ds.reload(key)
+            else:
+                continue
+            changed.append('.'.join([ds.fullName, key]))
+        if dnames is not None:
+            changed.extend(self._pollDirectories(ds, dnames))
+        return changed
+
+    def _pollDirectories(self, ds, dnames):
+        changed = []
+        children = {key: child for key, child in ds.thunks.items()
+                    if isinstance(child, GameDatastore) and
+                    os.path.dirname(child._path) == ds._path}
+        for dname in dnames:
+            if dname not in children and dname not in ds.thunks:
+                child = ds.__class__(os.path.join(ds._path, dname), ds,
+                                     lazy=ds.lazy)
+                ds.add(child.name, child)
+                for sub in self._datastores(child):
+                    self._snapshot(sub)
+                changed.append(child.fullName)
+        for key, child in children.items():
+            if key not in dnames and key not in ds._shouldSave:
+                ds.remove(key)
+                changed.append('.'.join([ds.fullName, key]))
+        return changed
+
+
+def _listFiles(path):
+    """List a directory, returning ({filename: (size, mtime)},
+    subdirectories)."""
+    files, dnames = {}, []
+    for entry in os.scandir(path):
+        if entry.is_file():
+            st = entry.stat()
+            files[entry.name] = (st.st_size, st.st_mtime_ns)
+        elif entry.is_dir():
+            dnames.append(entry.name)
+    return files, dnames
+
+
+def _raw(path, key, format):
+    """Parse the file `key` + `format` in the directory `path`."""
+    fullpath = os.path.join(path, key + format)
+    if os.path.isfile(fullpath):
+        if archon.datahandlers.dataparser.contains(format):
+            loader = archon.datahandlers.dataparser.get(format)
+            f = open(fullpath)
+            data = loader(f.read())
+            f.close()
+            if not data:
+                raise ValueError('Error loading data from ' + fullpath)
+            return data
+        else:
+            raise ValueError(
+                'Format {} unsupported (key {} in {})'.format(
+                    format, key, os.path.basename(path)))
+    else:
+        raise IOError('No such key {} (format {}) in {}'.format(
+                key, format, os.path.basename(path)))
+
+
+def _header(path, key, format):
+    """Read the type of the file `key` + `format` in the directory `path`."""
+    if archon.datahandlers.dataheader.contains(format):
+        fullpath = os.path.join(path, key + format)
+        if not os.path.isfile(fullpath):
+            raise IOError('No such key {} (format {}) in {}'.format(
+                    key, format, os.path.basename(path)))
+        with open(fullpath) as f:
+            objtype = archon.datahandlers.dataheader.get(format)(f)
+        if objtype:
+            return objtype
+    return _raw(path, key, format)['type']
+
+
+def _scanDirectory(path, previous, stat):
+    """
+    List a directory, returning (mtime, filenames, subdirectories).
+
+    If `stat` is true, the modification time is read, and if it matches the
+    previous manifest entry, the listing is taken from the manifest instead.
+    """
+    mtime = os.stat(path).st_mtime_ns if stat else None
+    if previous and previous['mtime'] == mtime:
+        return mtime, list(previous['files']), list(previous['directories'])
+    fnames, dnames = [], []
+    for fname in os.listdir(path):
+        fullpath = os.path.join(path, fname)
+        if os.path.isfile(fullpath):
+            fnames.append(fname)
+        elif os.path.isdir(fullpath):
+            dnames.append(fname)
+    return mtime, fnames, dnames
+
+
+def _scanFile(path, fname, lazy, stat, entry=None):
+    """
+    Scan a file, returning (filename, key, type, data, manifest entry).
+
+    The data is None if `lazy` is true; the manifest entry is None unless
+    `stat` is true, in which case the type is taken from the previous
+    manifest `entry` if the file's size and modification time match.
+    """
+    key, format = os.path.splitext(fname)
+    data = newEntry = None
+    if stat:
+        st = os.stat(os.path.join(path, fname))
+        if (entry and entry['size'] == st.st_size and
+            entry['mtime'] == st.st_mtime_ns):
+            objtype = entry['type']
+        else:
+            objtype = _header(path, key, format)
+        newEntry = {'type': objtype,
+                    'size': st.st_size,
+                    'mtime': st.st_mtime_ns}
+    elif lazy:
+        objtype = _header(path, key, format)
+    else:
+        data = _raw(path, key, format)
+        objtype = data['type']
+    return fname, key, objtype, data, newEntry
+
+
 class EntityJSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, archon.objects.Entity):
             # TODO check for mutable entities
             return o.location
+        elif isinstance(o, archon.common.CopyOnWriteDict):
+            return o.materialize()
         else:
             return super().default(o)
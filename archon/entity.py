@@ -1,6 +1,9 @@
 import copy
+import warnings
 import collections
 
+import archon.common
+
 
 class EntityHookNotFoundError(Exception): pass
 
@@ -8,7 +11,17 @@ class EntityHookNotFoundError(Exception): pass
 class EntityHook(collections.Mapping):
     """
     Defines special behavior for the attributes of certain entity kinds.
+
+    Subclasses that define a `KIND` are registered in :attr:`hooks` as they
+    are created. A class with the same module and name as the registered
+    one (as when its module is reloaded) replaces it, keeping its
+    templates. If two different hooks define the same kind, the first one
+    stays registered and a warning is given.
+
+    Hooks use `__slots__`; subclasses that add instance attributes should
+    declare them in their own `__slots__`.
     """
+    __slots__ = ('entity', '_attributes')
 
     """The `kind` of the entity."""
     KIND = ''
@@ -17,6 +30,28 @@ class EntityHook(collections.Mapping):
     templates = {}
     mutable = False
 
+    """The registered hooks by kind."""
+    hooks = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'KIND' not in cls.__dict__:
+            return
+        registered = EntityHook.hooks.setdefault(cls.KIND, cls)
+        if registered is cls:
+            return
+        if (registered.__module__, registered.__qualname__) == (
+                cls.__module__, cls.__qualname__):
+            if ('templates' in registered.__dict__ and
+                'templates' not in cls.__dict__):
+                cls.templates = registered.templates
+            EntityHook.hooks[cls.KIND] = cls
+        else:
+            warnings.warn(
+                'Entity hook {} for kind {} conflicts with {}'.format(
+                    cls.__qualname__, cls.KIND, registered.__qualname__),
+                RuntimeWarning, stacklevel=2)
+
     def __init__(self, entity, attributes):
         self.entity = entity
         self._attributes = attributes
@@ -66,16 +101,13 @@ class EntityHook(collections.Mapping):
     def getHook(cls, kind):
         """
         Find an entity hook based on class kind.
+
+        Only this class and its subclasses are considered.
         """
-        if cls.KIND == kind:
-            return cls
-        else:
-            for subcls in cls.__subclasses__():
-                try:
-                    return subcls.getHook(kind)
-                except EntityHookNotFoundError:
-                    continue
-        raise EntityHookNotFoundError(kind)
+        hook = EntityHook.hooks.get(kind)
+        if hook is None or not issubclass(hook, cls):
+            raise EntityHookNotFoundError(kind)
+        return hook
 
     @property
     def attributes(self):
@@ -95,9 +127,13 @@ class EntityHook(collections.Mapping):
             return self.entity.name
 
     def viaTemplate(self, attributes):
-        """Format attributes using this entity as a template."""
-        # TODO use archon.common.Merge
-        result = copy.deepcopy(self.attributes)
+        """
+        Format attributes using this entity as a template.
+
+        The result shares the template's attributes, storing only the given
+        ones (see :class:`archon.common.CopyOnWriteDict`).
+        """
+        result = archon.common.CopyOnWriteDict(self.attributes)
         stack = [(result, attributes)]
         while stack:
             dst, src = stack.pop()
@@ -114,14 +150,140 @@ class EntityHook(collections.Mapping):
 class MutableEntityHook(EntityHook, collections.MutableMapping):
     """
     A mutable entity hook.
+
+    The hook tracks whether it has changed since it was last saved. Setting
+    or deleting an attribute marks it dirty, as do changes inside nested
+    attributes when they are copy-on-write (as for instances); otherwise
+    those must call :meth:`markDirty`. Either also makes the entity forget
+    its cached friendly name.
+
+    Changes are sent through :attr:`onChange`, with the entity as sender
+    and the top-level `key`, the `path` of keys to the changed value, the
+    `value` (None if deleted) and whether it was `deleted`. Changes inside
+    nested attributes are sent when the attributes are copy-on-write (as
+    for instances); otherwise they are sent for the keys given to
+    :meth:`markDirty`. Use :meth:`connectChanges` to only receive some.
     """
+    __slots__ = ('_dirty', 'patch')
     mutable = True
+    onChange = archon.common.signal('entity.change')
+
+    """Attribute keys whose changes do not need to be saved."""
+    volatile = ()
+
+    def __init__(self, entity, attributes):
+        super().__init__(entity, attributes)
+        self._dirty = False
+        self.patch = None
+        if isinstance(attributes, archon.common.CopyOnWriteDict):
+            attributes.listener = self._changed
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if not isinstance(self._attributes, archon.common.CopyOnWriteDict):
+            self._changed((key,), value, False)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if not isinstance(self._attributes, archon.common.CopyOnWriteDict):
+            self._changed((key,), None, True)
+
+    def _changed(self, path, value, deleted):
+        if path[0] not in self.volatile:
+            self._dirty = True
+        if self.entity is not None:
+            self.entity.invalidate()
+        if self.onChange.receivers and self.entity is not None:
+            self.onChange.send(self.entity, key=path[0], path=path,
+                               value=value, deleted=deleted)
+
+    @classmethod
+    def connectChanges(cls, receiver, entity=None, key=None):
+        """
+        Connect `receiver` to the changes of `entity` (or of any entity),
+        and only of the top-level attribute `key` if given.
+
+        The receiver is held strongly, so lambdas and closures work; it
+        stays connected until the returned function is disconnected from
+        :attr:`onChange`.
+        """
+        sender = {} if entity is None else {'sender': entity}
+        if key is None:
+            connected = receiver
+        else:
+            def connected(entity, **change):
+                if change['key'] == key:
+                    return receiver(entity, **change)
+        cls.onChange.connect(connected, weak=False, **sender)
+        return connected
+
+    def markDirty(self, *keys):
+        """Mark the attributes as changed since the last save, sending a
+        change for each of the given top-level `keys`."""
+        self._dirty = True
+        if self.entity is not None:
+            self.entity.invalidate()
+        for key in keys:
+            self._changed((key,), self.get(key), key not in self)
+
+    def markClean(self):
+        """Mark the attributes as saved."""
+        self._dirty = False
+
+    @property
+    def dirty(self):
+        """Whether the attributes changed since the last save."""
+        return self._dirty
+
+    @property
+    def modified(self):
+        """Whether the attributes may differ from the prototype's."""
+        if self.dirty or self.patch:
+            return True
+        if isinstance(self._attributes, archon.common.CopyOnWriteDict):
+            return bool(self._attributes.patch())
+        return True  # cannot tell without the prototype
+
+    def diff(self, prototype):
+        """
+        Create a patch from the prototype's attributes, if they changed.
+
+        The patch is remembered until the attributes change again, so clean
+        instances are not serialized or compared again; it is made on the
+        first call, as attributes may start out changed (as for instances
+        loaded from a save game). If the attributes are a copy-on-write copy
+        of the prototype's, the patch is made from the changes alone.
+        """
+        if self.dirty or self.patch is None:
+            attributes = self.attributes
+            if (isinstance(attributes, archon.common.CopyOnWriteDict) and
+                attributes.base is prototype.attributes.attributes):
+                self.patch = attributes.patch()
+            else:
+                self.patch = archon.common.Merge(
+                    prototype.attributes.save(), self.save()).compared()
+            self.markClean()
+        return self.patch
 
     def copy(self):
         """
-        Returns a shallow-copy of the attributes dictionary.
+        Returns a copy-on-write copy of the attributes dictionary.
         """
-        return self.attributes.copy()
+        return archon.common.CopyOnWriteDict(self.attributes)
+
+
+def refreshTemplates(entity, datastore, key):
+    """Replace a reloaded or removed template of any entity hook."""
+    for hook in set(EntityHook.hooks.values()):
+        templates = hook.__dict__.get('templates', {})
+        for name, template in list(templates.items()):
+            if template is entity:
+                if key in datastore:
+                    templates[name] = datastore[key]
+                else:
+                    del templates[name]
+
+archon.common.signal('datastore.reload').connect(refreshTemplates)
 
 
 class Entity(object):
@@ -133,13 +295,24 @@ class Entity(object):
     particular area. This copy is stored in a different location in the
     datastore: it is stored in the same datastore as the player under a
     sub-datastore named "instances".
+
+    Entities use `__slots__` to stay small; subclasses such as
+    :class:`archon.objects.Room` may still add attributes freely.
+
+    The location and friendly name are cached. Renaming the entity, moving
+    its datastore or changing its attributes through the hook (see
+    :class:`MutableEntityHook`) makes it compute them again; anything else
+    that changes the friendly name should call :meth:`invalidate`.
     """
+    __slots__ = ('_name', 'kind', '_entityCache', 'prototype', '_location',
+                 '_attributes', '_cachedLocation', '_friendlyName',
+                 '__weakref__')
 
     """The instances datastore in the player's datastore."""
     instances = None
 
     def __init__(self, name, kind, cache, attributes={}, prototype=None,
-                 location=None):
+                 location=None, hook=None):
         """
         :param name: The name of the entity (the key in the datastore)
         :param kind: The entity's kind (enemy, door, object, etc.)
@@ -147,6 +320,8 @@ class Entity(object):
         :param prototype: The prototype of this entity.
         :param location: If given, an alternate location in the datastore
                          for the entity (used for instances).
+        :param hook: If given, the entity hook class to wrap the attributes
+                     in, instead of looking it up by kind.
 
         Change the type of an entity when it needs special
         loading/processing, as with a room, but the kind otherwise.
@@ -159,11 +334,12 @@ class Entity(object):
         if issubclass(attributes.__class__, EntityHook):
             self._attributes = attributes
         else:
-            try:
-                kindhook = EntityHook.getHook(kind)
-                self._attributes = kindhook(self, attributes)
-            except EntityHookNotFoundError:
-                self._attributes = EntityHook(self, attributes)
+            if hook is None:
+                try:
+                    hook = EntityHook.getHook(kind)
+                except EntityHookNotFoundError:
+                    hook = EntityHook
+            self._attributes = hook(self, attributes)
 
     def copy(self, instanced=True, name=None, attributes=None):
         """Perform a shallow copy if mutable, else return self.
@@ -183,10 +359,8 @@ class Entity(object):
                 instances = Entity.instances[self.kind]
                 if name:  # datahandlers - loading an instance
                     newName = name
-                elif instances:
-                    newName = max(int(key) for key in instances.keys()) + 1
                 else:
-                    newName = 0
+                    newName = instances.newKey()
                 entity = Entity(
                     str(newName), self.kind, self.entityCache,
                     attributes, prototype=self,
@@ -200,6 +374,26 @@ class Entity(object):
         else:
             return self
 
+    def spawn(self, count):
+        """Create `count` instances at once, as :meth:`copy` would.
+
+        The hook class is looked up once, the keys are allocated as one
+        block and the instances are added to Entity.instances in one
+        update. An immutable entity is returned `count` times.
+        """
+        if not self.mutable:
+            return [self] * count
+        if self.kind not in Entity.instances:
+            Entity.instances.create(self.kind)
+        instances = Entity.instances[self.kind]
+        hook = self.attributes.__class__
+        spawned = [Entity(key, self.kind, self.entityCache,
+                          self.attributes.copy(), prototype=self,
+                          location=instances, hook=hook)
+                   for key in instances.newKeys(count)]
+        instances.update((entity.name, entity) for entity in spawned)
+        return spawned
+
     def __deepcopy__(self, memo):
         return self.copy()
 
@@ -221,7 +415,23 @@ class Entity(object):
     @property
     def friendlyName(self):
         """The entity name for display purposes; defaults to name."""
-        return self.attributes.friendlyName
+        if self._friendlyName is None:
+            self._friendlyName = self.attributes.friendlyName
+        return self._friendlyName
+
+    @property
+    def name(self):
+        """The name of the entity (the key in the datastore)."""
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the cached location and friendly name."""
+        self._cachedLocation = self._friendlyName = None
 
     @property
     def attributes(self):
@@ -249,7 +459,13 @@ class Entity(object):
     @property
     def location(self):
         """The location of this entity in the datastore."""
-        return '.'.join([self._location.fullName, self.name])
+        # the full name of a datastore is a new string once it moves
+        fullName = self._location.fullName
+        cached = self._cachedLocation
+        if cached is None or cached[0] is not fullName:
+            cached = self._cachedLocation = (
+                fullName, '.'.join([fullName, self._name]))
+        return cached[1]
 
     @property
     def mutable(self):
@@ -13,7 +13,9 @@ from archon.entity import (Entity, EntityHook, EntityHookNotFoundError,
 
 
 class RoomEntityHook(MutableEntityHook):
+    __slots__ = ()
     KIND = "room"
+    volatile = ('time',)
 
     def __init__(self, entity, attributes):
         super(RoomEntityHook, self).__init__(entity, attributes)
@@ -44,49 +46,89 @@ class InventoryProxy:
     Stores inventory information in a dictionary.
 
     The keys are the locations of the entities. If the entity kind is
-    mutable, then the value is a list of entities; else, it is a count
-    denoting the quantity held.
+    mutable, then the value is a dictionary whose keys are the entities
+    (in the order they were added); else, it is a count denoting the
+    quantity held.
+
+    The total count is kept as items are added and removed. The first
+    :meth:`find` by name indexes the items by lowercase friendly name, and
+    the index is kept up to date after that; call :meth:`reindex` if held
+    items are renamed.
     """
+    __slots__ = ('inventory', 'cache', 'dirty', '_count', '_names',
+                 '_locationNames')
     def __init__(self, items, cache):
         self.inventory = {}
         self.cache = cache
+        self.dirty = False
+        self._count = 0
+        self._names = self._locationNames = None
 
         for path, values in items.items():
             path = cache.fullPathFor(path)
+            if isinstance(values, list):
+                values = dict.fromkeys(
+                    cache.lookup(value) if isinstance(value, str) else value
+                    for value in values)
+                self._count += len(values)
+            else:
+                self._count += values
             self.inventory[path] = values
 
     def add(self, item, quantity=1):
+        self.dirty = True
         if isinstance(item, Entity):
+            loc = item.location
             if item.mutable:
-                if item.location not in self.inventory:
-                    self.inventory[item.location] = []
-                self.inventory[item.location].append(item)
+                items = self.inventory.setdefault(loc, {})
+                quantity = 0 if item in items else 1
+                items[item] = None
             else:
-                if item.location not in self.inventory:
-                    self.inventory[item.location] = 0
-                self.inventory[item.location] += quantity
+                self.inventory[loc] = self.inventory.get(loc, 0) + quantity
         else:
-            item = self.cache.fullPathFor(item)
-            if item not in self.inventory:
-                self.inventory[item] = 0
-            self.inventory[item] += quantity
+            loc = self.cache.fullPathFor(item)
+            self.inventory[loc] = self.inventory.get(loc, 0) + quantity
+        self._count += quantity
+        if self._names is not None and loc not in self._locationNames:
+            self._index(loc)
 
     def remove(self, item, quantity='all'):
+        """Remove an item, given as an entity or a location.
+
+        A mutable entity must itself be held, else :exc:`KeyError` is
+        raised; a location removes any instance held there."""
         if isinstance(item, Entity):
             loc = item.location
-            if loc in self.inventory:
-                if item.mutable:
-                    self.inventory[loc].remove(item)
-                else:
-                    self.inventory[loc] -= 1
-                if not self.inventory[loc]:
-                    del self.inventory[loc]
         else:
-            item = self.cache.fullPathFor(item)
-            if item in self.inventory:
-                self.inventory[item] -= 1
-                if not self.inventory[item]:
-                    del self.inventory[item]
+            loc = self.cache.fullPathFor(item)
+        items = self.inventory.get(loc)
+        if isinstance(item, Entity) and item.mutable and (
+                not isinstance(items, dict) or item not in items):
+            raise KeyError(item)
+        if items is None:
+            return
+        self.dirty = True
+        if isinstance(items, dict):
+            if item not in items:
+                item = next(iter(items))  # any instance of the location
+            del items[item]
+        else:
+            self.inventory[loc] -= 1
+        self._count -= 1
+        if not self.inventory[loc]:
+            del self.inventory[loc]
+            if self._names is not None:
+                name = self._locationNames.pop(loc)
+                del self._names[name][loc]
+                if not self._names[name]:
+                    del self._names[name]
+
+    def get(self, loc):
+        """Return the (first) entity held at a location."""
+        items = self.inventory[loc]
+        if isinstance(items, dict):
+            return next(iter(items))
+        return self.cache.lookup(loc)
 
     def locations(self):
         """Iterate through the entity locations of held items."""
@@ -95,7 +137,7 @@ class InventoryProxy:
     def counts(self):
         """Iterate through the locations and counts of held items."""
         for loc, items in self.inventory.items():
-            if isinstance(items, list):
+            if isinstance(items, dict):
                 yield (loc, len(items))
             else:
                 yield (loc, items)
@@ -108,8 +150,8 @@ class InventoryProxy:
         list. Else, it will be the list of entity instances.
         """
         for loc, items in self.inventory.items():
-            if isinstance(items, list):
-                yield (loc, len(items), items)
+            if isinstance(items, dict):
+                yield (loc, len(items), list(items))
             else:
                 yield (loc, items, [self.cache.lookup(loc)])
 
@@ -119,29 +161,53 @@ class InventoryProxy:
             return []
         if len(args) == 1:
             # Possibly a location
-            if args[0] in self.locations():
+            if args[0] in self.inventory:
                 return self.get(args[0])
         criterion = ' '.join(args).lower()
-        for loc, count, items in self.entities():
-            for item in items:
-                if item.friendlyName.lower() == criterion:
-                    return item
+        if self._names is None:
+            self.reindex()
+        for loc in self._names.get(criterion, ()):
+            item = self.get(loc)
+            if item.friendlyName.lower() == criterion:
+                return item
         raise KeyError
 
+    def reindex(self):
+        """Index the held items by friendly name again."""
+        self._names = {}
+        self._locationNames = {}
+        for loc in self.inventory:
+            self._index(loc)
+
+    def _index(self, loc):
+        name = self.get(loc).friendlyName.lower()
+        self._locationNames[loc] = name
+        self._names.setdefault(name, {})[loc] = None
+
     def save(self):
         res = {}
         for loc, items in self.inventory.items():
-            if isinstance(items, list):
-                res[loc] = map(lambda x: x.location, items)
+            if isinstance(items, dict):
+                res[loc] = [item.location for item in items]
             else:
                 res[loc] = items
         return res
 
     def __len__(self):
-        return sum(d[1] for d in self.entities())
+        return self._count
 
 
 class PlayerEntityHook(MutableEntityHook):
+    """
+    The hook for players and other characters.
+
+    The derived :attr:`stats`, :attr:`maxVitals` and :attr:`level` are
+    computed once for the current acumen values and default template, and
+    shared until either changes or the acumen or maximum vitals are changed
+    (as seen by :meth:`markDirty` or copy-on-write attributes); do not
+    change them.
+    """
+    __slots__ = ('_inventory', '_derived')
     KIND = "player"
 
     """The equations used to calculate stats based on acumen."""
@@ -159,7 +225,9 @@ class PlayerEntityHook(MutableEntityHook):
         }
 
     def __init__(self, entity, attributes):
-        if self.templates:
+        # copies of a player already have the template applied
+        if (self.templates and
+            not isinstance(attributes, archon.common.CopyOnWriteDict)):
             attributes = self.templates['default'].attributes.viaTemplate(
                 attributes)
         super().__init__(entity, attributes)
@@ -171,6 +239,8 @@ class PlayerEntityHook(MutableEntityHook):
             if isinstance(location, str):
                 attributes['equip'][slot] = cache.lookup(location)
         self._inventory = InventoryProxy(attributes['inventory'], cache)
+        self._derived = (None, {})
+        self.markClean()  # resolving the equipment is not a change
 
     @classmethod
     def defaultInstance(cls):
@@ -196,16 +266,41 @@ class PlayerEntityHook(MutableEntityHook):
             self.vitals[target] = 0
         elif self.vitals[target] > self.maxVitals[target]:
             self.vitals[target] = self.maxVitals[target]
+        self.markDirty('vitals')  # keeps the derived values
         return realDamage
 
     def save(self):
         data = super().save()
+        data['equip'] = dict(data['equip'])
         for slot, entity in self.attributes['equip'].items():
             if entity:
                 data['equip'][slot] = entity.location
         data['inventory'] = self.inventory.save()
         return data
 
+    def diff(self, prototype):
+        if self.inventory.dirty:
+            self.attributes['inventory'] = self.inventory.save()
+        return super().diff(prototype)
+
+    def _changed(self, path, value, deleted):
+        super()._changed(path, value, deleted)
+        if path[0] in ('acumen', 'maxVitals'):
+            self._derived = (None, {})
+
+    def markDirty(self, *keys):
+        super().markDirty(*keys)
+        if not keys:
+            self._derived = (None, {})  # anything may have changed
+
+    def markClean(self):
+        super().markClean()
+        self.inventory.dirty = False
+
+    @property
+    def dirty(self):
+        return self._dirty or self.inventory.dirty
+
     @property
     def friendlyName(self):
         return 'You'  # self.character['name']
@@ -235,24 +330,46 @@ class PlayerEntityHook(MutableEntityHook):
         """The vitals dictionary."""
         return self.attributes['vitals']
 
+    def _derivedCache(self):
+        """The cache of derived values, emptied when the acumen or the
+        template changes."""
+        key = (tuple(self.acumen.items()), self.templates.get('default'))
+        if self._derived[0] != key:
+            self._derived = (key, {})
+        return self._derived[1]
+
     @property
     def level(self):
         """The level of the character."""
-        return math.floor(sum(abs(x) for x in self.acumen.values()) / 100)
+        cache = self._derivedCache()
+        if 'level' not in cache:
+            cache['level'] = math.floor(
+                sum(abs(x) for x in self.acumen.values()) / 100)
+        return cache['level']
 
     @property
     def maxVitals(self):
         """The maximum vital amount."""
-        res = {}
-        for vital, multipliers in self.attributes['maxVitals'].items():
-            res[vital] = round(sum(
-                    multiplier * abs(acumen) for multiplier, acumen in
-                    zip(multipliers, sorted(self.acumen.values()))))
-        return res
+        cache = self._derivedCache()
+        if 'maxVitals' not in cache:
+            acumen = sorted(self.acumen.values())
+            cache['maxVitals'] = {
+                vital: round(sum(multiplier * abs(value) for
+                                 multiplier, value in
+                                 zip(vitalMultipliers, acumen)))
+                for vital, vitalMultipliers in
+                self.attributes['maxVitals'].items()}
+        return cache['maxVitals']
 
     @property
     def stats(self):
         """The stats dictionary."""
+        cache = self._derivedCache()
+        if 'stats' not in cache:
+            cache['stats'] = self._stats()
+        return cache['stats']
+
+    def _stats(self):
         allStats = collections.defaultdict(dict)
         template = self.templates['default'].attributes['stats']['template']
         for acumenName, acumenSkill in self.acumen.items():
@@ -275,6 +392,8 @@ class PlayerEntityHook(MutableEntityHook):
 
 class EntityKey(collections.namedtuple('EntityKey', 'key prefix')):
     """Contains the entity's name and its "prefix" (a, an, another, etc.)"""
+    __slots__ = ()
+
     def __str__(self):
         return ' '.join([self.prefix, self.key])
 
@@ -290,18 +409,42 @@ class Room(Entity):
     within rooms; however, rooms do not contain the actual entity objects,
     simply metadata to describe them. When an interaction occurs, a copy is
     created of the object and is stored in a room-specific cache.
+
+    Rooms keep the data they were loaded from in :attr:`source`, so that
+    saving a changed room does not need to read it again.
+
+    The description of the room and the summaries of its entities are
+    cached until the contents or exits change, or messages are reloaded
+    (which increments :attr:`descriptionGeneration`).
     """
     ROOM_ENTITY_KIND = 'room'
     onEnter = archon.common.signal('room.enter')
 
+    """Incremented to make every room describe itself again."""
+    descriptionGeneration = 0
+
     def __init__(self, name, description, cache):
         super().__init__(name, Room.ROOM_ENTITY_KIND, cache, {})
+        self.source = None
+        self.patch = None
         self._entityCopies = {}
         self._description = description
         self._contents = {}
+        self._tokens = {}
         self._outputs = {}
+        self._descriptions = (None, {})
         self.area = None
 
+    @property
+    def area(self):
+        """The area entity of this room, or None."""
+        return self._area
+
+    @area.setter
+    def area(self, area):
+        self._area = area
+        self.invalidate()  # the friendly name includes the area
+
     def naturalFind(self, text):
         """
         Attempt to find an entity key based on a variety of criteria.
@@ -310,29 +453,28 @@ class Room(Entity):
         matches. Else, return the only match. Returns None if there is no
         match.
 
-        This method is case-insensitive.
+        This method is case-insensitive. The entity keys are looked up in
+        an index of their words, kept by :meth:`add` and :meth:`remove`.
         """
-        criteria = [word.strip().lower() for word in text.split()]
-        matches = set()
-        for eKey in self.contents:
-            prefix = [word.strip().lower() for word in eKey.prefix.split()]
-            key = [word.strip().lower() for word in eKey.key.split()]
-            prefixLength, keyLength = len(prefix), len(key)
-            # 2 cases: only identity, or prefix-identity
-            if len(criteria) < prefixLength + keyLength:
-                # in this case, only identity
-                if criteria == key:
-                    matches.add(eKey)
-            else:
-                if (criteria[:prefixLength] == prefix and
-                    criteria[prefixLength:] == key):
-                    matches.add(eKey)
+        matches = self._tokens.get(self._words(text))
         if not matches:
             return None
         elif len(matches) == 1:
-            return matches.pop()
+            return next(iter(matches))
         else:
-            return matches
+            return set(matches)
+
+    @staticmethod
+    def _words(text):
+        return tuple(word.strip().lower() for word in text.split())
+
+    def _indexKeys(self, eKey):
+        """The word sequences that find an entity key: its identity, with
+        or without its prefix."""
+        if isinstance(eKey, EntityKey):
+            key = self._words(eKey.key)
+            return {key, self._words(eKey.prefix) + key}
+        return {self._words(eKey)}
 
     def add(self, entityLocation, key, location='', description='',
             prefix='', messages='third_person_neutral',
@@ -356,22 +498,75 @@ class Room(Entity):
         self._contents[key] = EntityData(
             entityLocation, key, location,
             description, prefix, messages, options)
+        for words in self._indexKeys(key):
+            self._tokens.setdefault(words, set()).add(key)
+        self._descriptions = (None, {})
         if instance:
             self._entityCopies[key] = instance
+        self.attributes.markDirty()
+
+    def spawn(self, entityLocation, keys, **info):
+        """
+        Add instances of an entity to the room, one per key, at once.
+
+        :param entityLocation: The entity object's location.
+        :param keys: The keys for the instances (e.g. EntityKeys with the
+                     prefixes "a" and "another").
+
+        The other arguments are the same as for :meth:`add`. The instances
+        are created with :meth:`Entity.spawn`; they are returned.
+        """
+        keys = list(keys)
+        messages = info.get('messages', 'third_person_neutral')
+        if isinstance(messages, str):
+            info['messages'] = self.entityCache.lookup(messages)
+        instances = self.entityCache.lookup(entityLocation).spawn(len(keys))
+        for key, instance in zip(keys, instances):
+            self.add(entityLocation, key, instance=instance, **info)
+        return instances
 
     def addRoom(self, direction, target):
         """Add an exit to this room."""
         self._outputs[direction] = target
+        self._descriptions = (None, {})
+        self.attributes.markDirty()
 
     def remove(self, key):
         """Remove an entity from this room."""
         del self.contents[key]
-        del self._entityCopies[key]
+        self.attributes.markDirty()
+        for words in self._indexKeys(key):
+            self._tokens[words].discard(key)
+            if not self._tokens[words]:
+                del self._tokens[words]
+        self._descriptions = (None, {})
+        self._entityCopies.pop(key, None)  # it may never have been copied
+
+    def reset(self, description):
+        """
+        Forget the contents, exits and attributes, to load the room again.
+
+        Copies of entities stay, so entities still in the room keep their
+        state.
+        """
+        roomTime = self.attributes['time']
+        self.attributes.attributes.clear()
+        self.attributes['time'] = roomTime
+        self._description = description
+        self._contents = {}
+        self._tokens = {}
+        self._outputs = {}
+        self._descriptions = (None, {})
+        self.source = self.patch = None
+        self.area = None
 
     def clearContents(self):
         """Clear the contents of this room."""
         self.contents.clear()
+        self._tokens.clear()
+        self._descriptions = (None, {})
         self._entityCopies.clear()
+        self.attributes.markDirty()
 
     def entityFor(self, key):
         """Retrieve or create a copy of an entity in this room."""
@@ -391,12 +586,7 @@ class Room(Entity):
                     entity = self.entityFor(key)
                     return entity.description
                 else:
-                    messages = entity.messages.attributes
-                    text = [messages.message('summary', entityData=entity)]
-                    if entity.description:
-                        text.append(messages.message('description',
-                                                     entityData=entity))
-                    return ' '.join(text)
+                    return self._cached(key, self._summarize, entity)
                     # text = 'There is {identity}{location}.'.format(
                     #     identity=entity[1],
                     #     location=' ' + entity[2] if entity[2] else ''
@@ -407,11 +597,43 @@ class Room(Entity):
             elif key in self.outputs:
                 return 'You can go {}.'.format(key)
         else:
-            outputs = 'Adjoining areas: ' + ', '.join(self.outputs)
-            return '\n'.join(
-                ['You are in ' + self._description] +
-                [self.describe(key) for key in sorted(self.contents)] +
-                [outputs])
+            return self._cached(None, self._describeRoom)
+
+    def _cached(self, key, describe, *args):
+        generation, descriptions = self._descriptions
+        if generation != Room.descriptionGeneration:
+            descriptions = {}
+            self._descriptions = (Room.descriptionGeneration, descriptions)
+        if key not in descriptions:
+            descriptions[key] = describe(*args)
+        return descriptions[key]
+
+    def _summarize(self, entity):
+        messages = self._messagesFor(entity).attributes
+        text = [messages.message('summary', entityData=entity)]
+        if entity.description:
+            text.append(messages.message('description', entityData=entity))
+        return ' '.join(text)
+
+    def _messagesFor(self, entity):
+        """The messages entity for an entity's data, replacing it in the
+        contents if it was reloaded since the entity was added."""
+        messages = entity.messages
+        cache = messages.entityCache
+        if cache is None or messages.name not in cache:
+            return messages
+        current = cache[messages.name]
+        if current is not messages and isinstance(current, Entity):
+            self._contents[entity.key] = entity._replace(messages=current)
+            messages = current
+        return messages
+
+    def _describeRoom(self):
+        outputs = 'Adjoining areas: ' + ', '.join(self.outputs)
+        return '\n'.join(
+            ['You are in ' + self._description] +
+            [self.describe(key) for key in sorted(self.contents)] +
+            [outputs])
 
     def enter(self, elapsedTime):
         """Enter the room at the given time."""
@@ -429,6 +651,43 @@ class Room(Entity):
         """Copy the room - this will return the room itself."""
         return self  # Rooms are mutable singletons
 
+    def diff(self):
+        """
+        Create a patch from the room's source data, if it changed.
+
+        The patch is remembered until the room changes again, so clean
+        rooms are not serialized or compared.
+        """
+        if self.dirty:
+            self.patch = archon.common.Merge(self.source,
+                                             self.save()).compared()
+            self.attributes.markClean()
+        return self.patch
+
+    def changes(self):
+        """
+        Create a patch of the changes to the room since it was read, to
+        load it again from changed data.
+
+        Only the entities added and removed and the changed attributes are
+        kept: the saved form of the entities that stayed, the description
+        and the exits differ from the data in form only, and would hide
+        changes made to the data.
+        """
+        data = (self.diff() or {}).get('update', {}).get('data', {})
+        changed = data.get('update', {})
+        update = {}
+        contents = {op: value
+                    for op, value in changed.get('contents', {}).items()
+                    if op in ('create', 'delete')}
+        if contents:
+            update['contents'] = contents
+        if 'attributes' in changed:
+            update['attributes'] = changed['attributes']
+        if not update:
+            return {}
+        return {'update': {'data': {'update': update}}}
+
     def save(self):
         """Create a saveable representation of the room."""
         res = {"contents": {}, "outputs": {},
@@ -440,6 +699,11 @@ class Room(Entity):
             res["outputs"][direction] = target.location
         return {"type": "room", "data": res}
 
+    @property
+    def dirty(self):
+        """Whether the room changed since the last save."""
+        return self.attributes.dirty
+
     @property
     def contents(self):
         return self._contents
@@ -457,6 +721,26 @@ class Room(Entity):
         pass
 
 
+def reloadRoom(room, datastore, key):
+    """Load a changed room again in place, keeping entity copies."""
+    if isinstance(room, Room) and key in datastore:
+        datastore[key]
+
+archon.common.signal('datastore.reload').connect(reloadRoom)
+
+
+def forgetDescriptions(entity, datastore, key):
+    """Make rooms describe themselves again when messages are reloaded."""
+    if isinstance(entity, Entity) and (
+        entity.kind in ('messages', 'message_template') or
+        hasattr(entity.attributes, 'message')):
+        if key in datastore:
+            datastore[key]  # load the new templates before describing
+        Room.descriptionGeneration += 1
+
+archon.common.signal('datastore.reload').connect(forgetDescriptions)
+
+
 class EntityData(collections.namedtuple(
     'EntityData',
     'objectLocation key location description prefix messages options'
@@ -464,6 +748,8 @@ class EntityData(collections.namedtuple(
     """
     Contains the metadata used by a room to describe an entity.
     """
+    __slots__ = ()
+
     def save(self):
         """Saves the metadata."""
         data = {key: val for key, val in self._asdict().items() if val}
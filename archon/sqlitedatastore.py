@@ -0,0 +1,192 @@
+"""
+Defines a game database stored in a single SQLite file.
+"""
+
+import os
+import json
+import sqlite3
+import concurrent.futures
+
+import archon.datahandlers
+import archon.datastore
+
+
+class SQLiteDatastore(archon.datastore.GameDatastore):
+    """
+    A lazy datastore kept in one SQLite database instead of a directory.
+
+    Every file of a :class:`GameDatastore` becomes a row of the `entries`
+    table, holding the dotted path of its datastore (the empty string for
+    the root), its key, type, format (file extension) and contents;
+    sub-datastores are rows without a type. Creating the root reads only
+    the keys and types, and the contents of a row are read when its thunk
+    is evaluated.
+
+    The root is created with the filename of the database; sub-datastores
+    are created by the root with their name and parent. The root's name
+    defaults to the filename without its extension, so a database imported
+    from ``resources`` and named ``resources.db`` gives the same entity
+    locations as the directory.
+    """
+
+    WATCHABLE = False
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS entries (
+        parent TEXT NOT NULL,
+        key TEXT NOT NULL,
+        type TEXT,
+        format TEXT,
+        data TEXT,
+        PRIMARY KEY (parent, key)
+    )
+    '''
+
+    def __init__(self, path, parent=None, name=None, maxLoaded=None,
+                 shared=False):
+        self._setup(parent, maxLoaded, shared=shared)
+        if parent is None:
+            self._filename = os.path.abspath(path)
+            self._name = name or os.path.splitext(
+                os.path.basename(self._filename))[0]
+            self._path = ''
+            self._connection = sqlite3.connect(self._filename)
+            self._connection.execute(self.SCHEMA)
+            self._rows = {}
+            for row in self._connection.execute(
+                'SELECT parent, key, type, format FROM entries'):
+                self._rows.setdefault(row[0], []).append(row[1:])
+        else:
+            self._name = path
+            self._path = '.'.join(filter(None, [parent._path, path]))
+            self._connection = parent._connection
+        for key, objtype, format in self.root._rows.pop(self._path, []):
+            if objtype is None:
+                self.add(key, self.__class__(key, self))
+            elif archon.datahandlers.dataloader.contains(objtype):
+                self.add(key, archon.datastore.DataThunk(
+                    self, key, None, key + format))
+
+    def create(self, key):
+        """Create a sub-datastore with the given name."""
+        assert key not in self
+        with self._connection:
+            self._connection.execute(
+                'INSERT INTO entries (parent, key) VALUES (?, ?)',
+                (self._path, key))
+        child = self.__class__(key, self)
+        self.add(child.name, child)
+        return child
+
+    def save(self, key, data=None, immediately=False):
+        """
+        Save the data to the database, or if the key exists, mark it for
+        saving.
+
+        This behaves like :meth:`GameDatastore.save`, except that immediate
+        saves are committed before returning; the returned future is
+        already done.
+        """
+        self._shouldSave.add(key)
+        if data:
+            self.add(key, data)
+        if immediately:
+            future = concurrent.futures.Future()
+            if data is None:
+                future.set_result(None)  # nothing to write
+                return future
+            text = json.dumps(data, indent=1,
+                              cls=archon.datastore.EntityJSONEncoder)
+            with self._connection:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                    (self._path, key, data['type'], '.json', text))
+            future.set_result(key)
+            return future
+
+    def raw(self, key, format=None):
+        """Returns the raw dict object stored in the database.
+
+        If `key` is a filename, pass in a format of `None`. Else, `format`
+        should be the file extension (with period) it was imported with."""
+        if not format:
+            key, format = os.path.splitext(key)
+        row = self._connection.execute(
+            'SELECT data FROM entries WHERE parent = ? AND key = ? AND '
+            'format = ?', (self._path, key, format)).fetchone()
+        if row is None:
+            raise IOError('No such key {} (format {}) in {}'.format(
+                    key, format, self.name))
+        if not archon.datahandlers.dataparser.contains(format):
+            raise ValueError('Format {} unsupported (key {} in {})'.format(
+                    format, key, self.name))
+        data = archon.datahandlers.dataparser.get(format)(row[0])
+        if not data:
+            raise ValueError('Error loading data from {}.{}'.format(
+                    self.fullName, key))
+        return key, data
+
+    def header(self, key, format=None):
+        """Returns the type of the object stored under `key`."""
+        if not format:
+            key, format = os.path.splitext(key)
+        row = self._connection.execute(
+            'SELECT type FROM entries WHERE parent = ? AND key = ? AND '
+            'format = ?', (self._path, key, format)).fetchone()
+        if row is None:
+            raise IOError('No such key {} (format {}) in {}'.format(
+                    key, format, self.name))
+        return key, row[0]
+
+    def close(self):
+        """Close the database connection."""
+        self._connection.close()
+
+
+def importDirectory(path, filename, name=None):
+    """
+    Copy a :class:`GameDatastore` directory into a SQLite database.
+
+    Only files that the directory datastore would load are copied. Returns
+    the new :class:`SQLiteDatastore`.
+    """
+    source = archon.datastore.GameDatastore(path, lazy=True)
+    connection = sqlite3.connect(filename)
+    connection.execute(SQLiteDatastore.SCHEMA)
+    with connection:
+        stack = [('', source)]
+        while stack:
+            prefix, ds = stack.pop()
+            for key, item in ds.thunks.items():
+                if isinstance(item, archon.datastore.GameDatastore):
+                    connection.execute(
+                        'INSERT OR REPLACE INTO entries (parent, key) '
+                        'VALUES (?, ?)', (prefix, key))
+                    stack.append(('.'.join(filter(None, [prefix, key])),
+                                  item))
+                elif isinstance(item, archon.datastore.DataThunk):
+                    _, objtype = ds.header(item.filename)
+                    format = os.path.splitext(item.filename)[1]
+                    with open(os.path.join(ds._path, item.filename)) as f:
+                        contents = f.read()
+                    connection.execute(
+                        'INSERT OR REPLACE INTO entries VALUES '
+                        '(?, ?, ?, ?, ?)',
+                        (prefix, key, objtype, format, contents))
+    connection.close()
+    return SQLiteDatastore(filename, name=name or source.name)
+
+
+def exportDirectory(filename, path):
+    """Write the contents of a SQLite database out as a directory."""
+    connection = sqlite3.connect(filename)
+    rows = connection.execute(
+        'SELECT parent, key, type, format, data FROM entries')
+    for parent, key, objtype, format, data in rows:
+        directory = os.path.join(path, *filter(None, parent.split('.')))
+        if objtype is None:
+            os.makedirs(os.path.join(directory, key), exist_ok=True)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, key + format), 'w') as f:
+                f.write(data)
+    connection.close()
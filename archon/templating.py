@@ -35,6 +35,7 @@ class TemplatingDict(dict):
 
 
 class MessageTemplateEntityHook(archon.entity.EntityHook):
+    __slots__ = ()
     KIND = "message_template"
     templates = {}
     splitRe = re.compile(r"({[^{}]*?@.*?})")
@@ -123,6 +124,7 @@ class MessageTemplateEntityHook(archon.entity.EntityHook):
 
 
 class MessagesEntityHook(archon.entity.EntityHook):
+    __slots__ = ()
     KIND = "messages"
 
     def message(self, name, *args, **kwargs):
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Compare the scalar and array (batchcombat) combat rules of the demo.
+
+Usage: combat.py [-n count] [-r rounds] demo
+
+Creates `count` copies of the demo's test enemy with random acumen and
+has each attack the next with the melee effect for `rounds` rounds, once
+through the entity hooks and once with the demo's batchcombat module.
+Reports the time taken and the mean stats, AP, health and hit rate of
+each, which should agree up to sampling noise. Without NumPy, only the
+entity hooks are run.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import importlib
+import statistics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import archon.datastore
+import archon.objects
+
+
+def scalar(enemies, effect, rounds):
+    entityhooks = importlib.import_module('entityhooks')
+    hits = attacks = 0
+    for _ in range(rounds):
+        for user, target in zip(enemies, enemies[1:] + enemies[:1]):
+            acumen = user.attributes.acumen['physical']
+            stats = user.attributes.stats['physical']
+            instance = effect.attributes.instance(acumen, stats)
+            attacks += 1
+            try:
+                instance.apply(user, target)
+                hits += 1
+            except (entityhooks.EffectMissed, entityhooks.NotEnoughAP):
+                pass
+    return hits / attacks
+
+
+def batch(batchcombat, enemies, effect, rounds, rng):
+    template = enemies[0].attributes.templates['default']
+    names, acumen = batchcombat.acumen(enemies)
+    physical = names.index('physical')
+    stats = batchcombat.stats(
+        acumen, template.attributes['stats']['template'])
+    userStats = {name: value[:, physical] for name, value in stats.items()}
+    maxVitals = batchcombat.maxVitals(
+        acumen, enemies[0].attributes['maxVitals'])
+    ap = maxVitals['ap'].astype(float)
+    health = maxVitals['health'].astype(float)
+    hits = 0
+    for _ in range(rounds):
+        # everyone attacks the next combatant at once
+        ap, targetHealth, hit = batchcombat.attack(
+            rng, effect.attributes.stats, acumen[:, physical], userStats,
+            ap, maxVitals['ap'], numpy.roll(health, -1),
+            numpy.roll(maxVitals['health'], -1),
+            numpy.roll(userStats['absorb'], -1, axis=0))
+        health = numpy.roll(targetHealth, 1)
+        hits += hit.sum()
+    return userStats, maxVitals, ap, health, hits / (rounds * len(enemies))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=10000)
+    parser.add_argument('-r', '--rounds', type=int, default=5)
+    parser.add_argument('demo')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.abspath(args.demo))
+    for module in ('datahandlers', 'entityhooks'):
+        importlib.import_module(module)
+    batchcombat = importlib.import_module('batchcombat')
+    ds = archon.datastore.GameDatastore(
+        os.path.join(args.demo, 'resources'), lazy=True)
+    data = ds['data']
+    data['metadata']
+    prototype = data['enemies.test_enemy']
+    effect = data['effects.template_melee']
+    enemies = []
+    for _ in range(args.count):
+        enemy = prototype.copy(instanced=False)
+        enemy.attributes['acumen'] = {
+            name: random.randint(-50, 199)
+            for name in ('physical', 'mental', 'spiritual')}
+        enemy.attributes.vitals.update(enemy.attributes.maxVitals)
+        enemies.append(enemy)
+
+    start = time.perf_counter()
+    stats = [enemy.attributes.stats for enemy in enemies]
+    maxVitals = [enemy.attributes.maxVitals for enemy in enemies]
+    scalarHits = scalar(enemies, effect, args.rounds)
+    scalarTime = time.perf_counter() - start
+    means = {}
+    if batchcombat.available:
+        start = time.perf_counter()
+        batchStats, batchMax, ap, health, batchHits = batch(
+            batchcombat, enemies, effect, args.rounds,
+            numpy.random.default_rng())
+        means['time (s)'] = time.perf_counter() - start
+        means.update((name + ' (upper)', value[:, 1].mean())
+                     for name, value in batchStats.items())
+        means.update(('max ' + vital, value.mean())
+                     for vital, value in batchMax.items())
+        means.update({'ap': ap.mean(), 'health': health.mean(),
+                      'hit rate': batchHits})
+    else:
+        print('NumPy is not installed; only running the entity hooks')
+
+    def row(name, precision, value):
+        array = means.get(name)
+        array = ('{:>12.{}f}'.format(array, precision) if array is not None
+                 else '{:>12}'.format('-'))
+        print('{:<16} {:>12.{}f} {}'.format(name, value, precision, array))
+
+    print('{} combatants, {} rounds'.format(args.count, args.rounds))
+    print('{:<16} {:>12} {:>12}'.format('', 'scalar', 'array'))
+    row('time (s)', 3, scalarTime)
+    for name in sorted(stats[0]['physical']):
+        row(name + ' (upper)', 4,
+            statistics.mean(s['physical'][name][1] for s in stats))
+    for vital in sorted(maxVitals[0]):
+        row('max ' + vital, 2, statistics.mean(m[vital] for m in maxVitals))
+    row('ap', 2, statistics.mean(e.attributes.vitals['ap'] for e in enemies))
+    row('health', 2,
+        statistics.mean(e.attributes.vitals['health'] for e in enemies))
+    row('hit rate', 4, scalarHits)
+
+if __name__ == '__main__':
+    main()
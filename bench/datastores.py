@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Compare the directory and SQLite datastores on a content tree.
+
+Usage: datastores.py [-m module]... path
+
+Modules (such as the demo's datahandlers) are imported first so that their
+dataparsers and dataloaders are registered. Reports the time to open each
+datastore and to parse every entry in it.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import importlib
+
+import archon.datastore
+import archon.sqlitedatastore
+
+
+def entries(ds):
+    stack = [ds]
+    while stack:
+        ds = stack.pop()
+        for key, item in ds.thunks.items():
+            if isinstance(item, archon.datastore.DataThunk):
+                yield ds, item
+            elif isinstance(item, archon.datastore.Datastore):
+                stack.append(item)
+
+
+def measure(label, opener):
+    start = time.perf_counter()
+    ds = opener()
+    opened = time.perf_counter()
+    count = 0
+    for parent, thunk in entries(ds):
+        parent.raw(thunk.filename)
+        count += 1
+    parsed = time.perf_counter()
+    print('{:<10} open {:8.2f} ms  parse {} entries {:8.2f} ms'.format(
+            label, (opened - start) * 1000, count, (parsed - opened) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--module', action='append', default=[])
+    parser.add_argument('path')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.path)))
+    for module in args.module:
+        importlib.import_module(module)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'content.db')
+        archon.sqlitedatastore.importDirectory(args.path, filename).close()
+        measure('directory', lambda: archon.datastore.GameDatastore(
+                args.path, lazy=True))
+        measure('sqlite', lambda: archon.sqlitedatastore.SQLiteDatastore(
+                filename, name=os.path.basename(args.path)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Measure the memory used per object by the core game classes.
+
+Usage: memory.py [-n count] [demo]
+
+Each class is compared with a subclass of it that does not declare
+`__slots__`, which gives its instances a `__dict__` like before the
+classes were slotted. If the path of the demo is given, the demo's Effect
+is measured too. Attribute dictionaries and caches are shared between the
+objects, so only the objects themselves are counted.
+"""
+import os
+import sys
+import argparse
+import importlib
+import tracemalloc
+
+import archon.entity
+import archon.objects
+
+
+def perObject(factory, count):
+    tracemalloc.start()
+    objects = [None] * count
+    before = tracemalloc.get_traced_memory()[0]
+    for index in range(count):
+        objects[index] = factory()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / count
+
+
+def measure(label, cls, factory, count):
+    unslotted = type(cls.__name__ + 'WithDict', (cls,), {})
+    slotted = perObject(lambda: factory(cls), count)
+    withDict = perObject(lambda: factory(unslotted), count)
+    print('{:<18} {:8.1f} B  (with __dict__ {:8.1f} B, {:5.1f}%)'.format(
+            label, slotted, withDict, 100 * slotted / withDict))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=100000)
+    parser.add_argument('demo', nargs='?')
+    args = parser.parse_args()
+    attributes = {'name': 'item'}
+    hook = archon.entity.EntityHook(None, attributes)
+    measure('Entity', archon.entity.Entity,
+            lambda cls: cls('item', 'item', None, hook), args.count)
+    measure('EntityHook', archon.entity.EntityHook,
+            lambda cls: cls(None, attributes), args.count)
+    measure('MutableEntityHook', archon.entity.MutableEntityHook,
+            lambda cls: cls(None, attributes), args.count)
+    measure('InventoryProxy', archon.objects.InventoryProxy,
+            lambda cls: cls({}, None), args.count)
+    measure('EntityKey', archon.objects.EntityKey,
+            lambda cls: cls('guard', 'a'), args.count)
+    measure('EntityData', archon.objects.EntityData,
+            lambda cls: cls('data.guard', 'guard', '', '', 'a', None, []),
+            args.count)
+    if args.demo:
+        sys.path.insert(0, os.path.abspath(args.demo))
+        entityhooks = importlib.import_module('entityhooks')
+        target = entityhooks.EffectTarget('vital', None, 'health')
+        measure('Effect', entityhooks.Effect,
+                lambda cls: cls(True, target, 5, 1, 2, None), args.count)
+
+if __name__ == '__main__':
+    main()
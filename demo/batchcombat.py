@@ -0,0 +1,174 @@
+"""
+Array versions of the stat and combat rules, for many combatants at once.
+
+The functions here follow :class:`archon.objects.PlayerEntityHook` and the
+effects in :mod:`entityhooks`, but take NumPy arrays with one row per
+combatant (or per attack) and draw their random numbers from a
+:class:`numpy.random.Generator`, so a round of a large encounter, or many
+rounds of an offline balance simulation, is a handful of array operations.
+The results have the same distributions as the scalar code; the individual
+rolls differ.
+
+Acumen arrays have one column per acumen name, in the order given to
+:func:`acumen`. Ranges such as the stat bounds have a last axis of two,
+the lower and upper bound.
+
+NumPy is optional: without it this module still imports, but
+:data:`available` is false and callers should use the per-entity rules.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import archon.objects
+
+"""Whether NumPy, and so the functions here, can be used."""
+available = numpy is not None
+
+"""The stat equations of PlayerEntityHook.equations, on arrays."""
+equations = {
+    'increasing': lambda x: 1 / (1 + numpy.exp(-x)),
+    'decreasing': lambda x: 1 / numpy.exp(x),
+    }
+
+
+def acumen(entities, names=None):
+    """
+    Collect the acumen of characters into an array.
+
+    :param entities: The entities, with :class:`PlayerEntityHook` hooks.
+    :param names: The acumen names (columns); defaults to those of the
+                  first entity.
+
+    Returns the names and the array.
+    """
+    entities = list(entities)
+    if names is None:
+        names = list(entities[0].attributes.acumen)
+    return names, numpy.array(
+        [[entity.attributes.acumen[name] for name in names]
+         for entity in entities], dtype=float)
+
+
+def stats(acumen, template, hook=archon.objects.PlayerEntityHook):
+    """
+    Compute the stats for an acumen array.
+
+    :param template: The stats template (the ``['stats']['template']`` of
+                     the default template).
+
+    Returns a dictionary of stat names to arrays of the shape of `acumen`
+    with a last axis of two, like :attr:`PlayerEntityHook.stats` indexed
+    by acumen and then stat.
+    """
+    result = {}
+    for statName, statType in template.items():
+        lbC = ubC = 0  # lower bound, upper bound constant terms
+        if isinstance(statType, list):
+            statType, lbC, ubC = statType
+        eqData = hook.equations[statType]
+        baseStat = equations[statType](acumen * eqData['scale'])
+        result[statName] = numpy.stack(
+            [c + (baseStat * (1 + v))
+             for v, c in zip(eqData['variance'], [lbC, ubC])], axis=-1)
+    return result
+
+
+def maxVitals(acumen, multipliers):
+    """
+    Compute the maximum vitals for an acumen array with one row per
+    character, given the ``maxVitals`` multipliers.
+
+    Returns a dictionary of vital names to integer arrays.
+    """
+    ordered = numpy.abs(numpy.sort(acumen, axis=-1))
+    result = {}
+    for vital, vitalMultipliers in multipliers.items():
+        # summed in the same order as the scalar code, to round the same
+        result[vital] = numpy.rint(sum(
+                multiplier * ordered[..., index] for index, multiplier in
+                zip(range(ordered.shape[-1]), vitalMultipliers))).astype(int)
+    return result
+
+
+def level(acumen):
+    """Compute the levels for an acumen array."""
+    return numpy.floor(numpy.abs(acumen).sum(axis=-1) / 100).astype(int)
+
+
+def uniform(rng, bounds):
+    """Draw one number uniformly between each pair of `bounds`."""
+    bounds = numpy.asarray(bounds, dtype=float)
+    return rng.uniform(bounds[..., 0], bounds[..., 1])
+
+
+def hits(rng, success, effectSuccess):
+    """Roll whether attacks hit, given the users' success stat bounds and
+    the effects' success."""
+    multiplier = uniform(rng, success)
+    return rng.random(multiplier.shape) <= multiplier * effectSuccess
+
+
+def magnitudes(rng, effectMagnitude, acumen):
+    """Roll the magnitudes of attacks, given the effects' magnitude ranges
+    and the users' acumen of the attack's type."""
+    effectMagnitude = numpy.asarray(effectMagnitude)
+    acumen = numpy.asarray(acumen, dtype=float)
+    shape = numpy.broadcast_shapes(effectMagnitude.shape[:-1], acumen.shape)
+    return rng.integers(effectMagnitude[..., 0], effectMagnitude[..., 1],
+                        size=shape, endpoint=True) * (acumen / 20)
+
+
+def drains(rng, drain, effectDrain):
+    """Roll the AP drained by attacks, given the users' drain stat bounds
+    and the effects' drain."""
+    return uniform(rng, drain) * effectDrain
+
+
+def damage(rng, vitals, maxVitals, magnitude, absorb=None):
+    """
+    Apply damage to a vital, as :meth:`PlayerEntityHook.damage` does.
+
+    :param vitals: The current values of the vital.
+    :param maxVitals: The maximum values of the vital.
+    :param magnitude: The damage (negative to heal).
+    :param absorb: The absorb stat bounds for the kind of the damage, or
+                   None if it cannot be absorbed.
+
+    Returns the new values of the vital.
+    """
+    magnitude = numpy.asarray(magnitude, dtype=float)
+    if absorb is not None:
+        magnitude = magnitude - uniform(rng, absorb) * magnitude
+    return numpy.clip(vitals - magnitude, 0, maxVitals)
+
+
+def attack(rng, effect, userAcumen, userStats, ap, maxAP,
+           vitals, maxVitals, absorb=None):
+    """
+    Resolve one attack per row, as creating an effect instance with
+    :meth:`EffectEntityHook.instance` and applying it does.
+
+    :param effect: The effect's stats (such as its ``damage`` attribute).
+    :param userAcumen: The users' acumen of the attack's type.
+    :param userStats: The users' stats for that acumen (see :func:`stats`).
+    :param ap: The users' AP, and `maxAP` their maximum.
+    :param vitals: The targets' values of the effect's target vital, and
+                   `maxVitals` their maximum.
+    :param absorb: The targets' absorb stat bounds for the effect's kind,
+                   or None if it has none.
+
+    Returns the users' new AP, the targets' new vital values and whether
+    each attack hit. Attacks by users without enough AP do nothing and do
+    not hit.
+    """
+    hit = hits(rng, userStats['success'], effect['success'])
+    magnitude = magnitudes(rng, effect['magnitude'], userAcumen)
+    drain = drains(rng, userStats['drain'], effect['drain'])
+    enough = drain <= ap
+    hit &= enough
+    newAP = numpy.where(enough, damage(rng, ap, maxAP, drain), ap)
+    newVitals = numpy.where(
+        hit, damage(rng, vitals, maxVitals, magnitude, absorb), vitals)
+    return newAP, newVitals, hit
@@ -112,6 +112,7 @@ def fight(output, context, player, *enemies: archon.commands.findMulti):
         if enemy.kind != 'enemy':
             raise output.error("You can't fight that.")
         enemy.attributes.vitals.update(enemy.attributes.maxVitals)
+        enemy.attributes.markDirty()
         enemyList.append(enemy)
         scene.add(data.objectLocation, data.key, data.location,
                   data.description, data.prefix, data.options, enemy)
@@ -45,3 +45,8 @@ def chatType(contents):
             topic, text, actions = line.strip(), [], []
     return {"type": "entity",
             "data": {"kind": "chat", "attributes": topics}}
+
+
+@archon.datahandlers.dataheader('.chat')
+def chatHeader(f):
+    return "entity"
@@ -5,6 +5,7 @@ import archon.objects
 
 
 class EnemyEntityHook(archon.objects.PlayerEntityHook):
+    __slots__ = ()
     KIND = 'enemy'
 
     @property
@@ -17,6 +18,7 @@ class EnemyEntityHook(archon.objects.PlayerEntityHook):
 
 
 class WeaponEntityHook(archon.objects.EntityHook):
+    __slots__ = ()
     KIND = 'weapon'
 
     @property
@@ -31,6 +33,8 @@ class NotEnoughAP(Exception): pass
 
 
 class Effect:
+    __slots__ = ('hit', 'target', 'magnitude', 'turns', 'drain', 'messages')
+
     def __init__(self, hit, target, magnitude, turns, drain, messages):
         self.hit = hit
         self.target = target
@@ -70,11 +74,14 @@ class Effect:
 
     def __repr__(self):
         a = "<Effect {hit} {target} {magnitude} {turns} {drain} {messages}>"
-        return a.format(**self.__dict__)
+        return a.format(**{name: getattr(self, name)
+                           for name in self.__slots__})
 
 
 class EffectTarget(collections.namedtuple('EffectTarget',
                                       'category kind target')):
+    __slots__ = ()
+
     @classmethod
     def viaString(cls, target):
         target = target.split(':')
@@ -91,6 +98,7 @@ EffectMessage = collections.namedtuple('EffectMessage',
 
 
 class EffectEntityHook(archon.objects.EntityHook):
+    __slots__ = ()
     KIND = 'effect'
 
     @classmethod
@@ -206,6 +214,7 @@ class Conversation:
 
 
 class NPCEntityHook(archon.objects.MutableEntityHook):
+    __slots__ = ('conversation',)
     KIND = 'npc'
 
     def __init__(self, entity, attributes):
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
+import os
 import sys
 import uuid
 import base64
 import datetime
+import itertools
 
 import archon
 import archon.common
 import archon.datahandlers
 import archon.datastore
+import archon.archive
 import archon.objects
 import archon.interface
 import archon.commands
@@ -18,12 +21,38 @@ import battlecommands
 import entityhooks
 
 if __name__ == '__main__':
-    ds = archon.datastore.GameDatastore('resources')
+    if os.path.isfile('resources.archive'):
+        # packed with: python -m archon.archive -m datahandlers -x save
+        #                  resources resources.archive
+        ds = archon.archive.ArchiveDatastore('resources.archive')
+        ds.add('save', archon.datastore.GameDatastore(
+                os.path.join('resources', 'save'), ds))
+    else:
+        ds = archon.datastore.GameDatastore('resources',
+                                            manifest='resources.manifest')
     data = ds['data']
     save = ds['save']
     metadata = data['metadata']  # load the metadata
     room = None
 
+    # pick up content edited while the game runs before each command
+    watcher = data.watch()
+    archon.commands.command.preExecute.connect(
+        lambda sender: watcher.poll(), weak=False)
+
+    # every so often, let instances nothing refers to any more be collected
+    commandCount = itertools.count(1)
+
+    def compactInstances(sender):
+        instances = archon.objects.Entity.instances
+        if next(commandCount) % 20 or instances is None:
+            return
+        report = instances.compact()
+        if interface.permissions.get('debug', False):
+            interface.display('Instances: {} held weakly, {} reclaimed'.format(
+                    report['weak'], report['reclaimed']))
+    archon.commands.command.postExecute.connect(compactInstances)
+
     interface = archon.interface.ConsoleInterface(
         permissions={'debug': True},
         messageTemplates=data['messages']['templates']
@@ -43,6 +72,7 @@ if __name__ == '__main__':
             player.entityCache = save.create(player.name)
             player.entityCache.create("instances")
         elif choice == 1:
+            save.flush()  # saves from this session may still be queued
             players = {}
             for key in save.keys():
                 savegame = save[key]
@@ -45,3 +45,4 @@ def main(output, context, player, npc, conversation):
                     stat=stat, value=stats[trait][stat]
                     ))
     player.attributes.vitals.update(player.attributes.maxVitals)
+    player.attributes.markDirty()
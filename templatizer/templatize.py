@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import copy
 import argparse
 
 import archon
@@ -6,6 +7,19 @@ import archon.common
 import archon.datastore
 
 
+def overrides(original, changed):
+    """The keys of `changed` that differ from `original`, recursively."""
+    result = {}
+    for key, item in changed.items():
+        if (type(item) == dict and type(original.get(key)) == dict):
+            item = overrides(original[key], item)
+            if item:
+                result[key] = item
+        elif original.get(key) != item:
+            result[key] = item
+    return result
+
+
 def main():
     datastore = archon.datastore.GameDatastore('data/')
     if 'output' not in datastore:
@@ -14,6 +28,10 @@ def main():
     parser = argparse.ArgumentParser("Generate entities via a template.")
     parser.add_argument('family', nargs=1, help='The item family.')
     parser.add_argument('types', nargs='+', help='Item types.')
+    parser.add_argument('-t', '--template',
+                        help='Datastore location of the item types in the '
+                        'game; if given, entities only store what differs '
+                        'from their type, which they use as a template.')
     args = parser.parse_args()
     family = datastore['families'].raw(args.family[0], '.json')[1]
     types = []
@@ -26,6 +44,7 @@ def main():
             patches[key.strip()] = patch
     for name, t in types:
         if name in patches:
+            original = copy.deepcopy(t['data'])
             patch = patches[name]
             stack = [(patch, t['data'])]
             while stack:
@@ -42,6 +61,13 @@ def main():
                 for key, item in target.items():
                     if type(item) == str:
                         target[key] = item.format(**family['data'])
+            if args.template:
+                t['data'] = {
+                    'kind': t['data']['kind'],
+                    'template': '.'.join([args.template, name]),
+                    'attributes': overrides(original['attributes'],
+                                            t['data']['attributes'])
+                    }
             output.save(family['data']['outputName'].format(type=name),
                         t, immediately=True)
             print("Saved entity of type {name} of family {family}".format(
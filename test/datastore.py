@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+import os
+import gc
+import json
+import shutil
+import unittest
+import concurrent.futures
+
+import archon
+import archon.archive
+import archon.common
+import archon.commands
+import archon.datahandlers
+import archon.datastore
+import archon.entity
+import archon.interface
+import archon.objects
+import archon.sqlitedatastore
+
+import helpers
+
+
+class TestLazyDatastore(unittest.TestCase):
+    def setUp(self):
+        self.ds = archon.datastore.GameDatastore('data', lazy=True)
+
+    def test_unparsed(self):
+        thunk = self.ds.thunkFor('formatting.templates')
+        self.assertIsInstance(thunk, archon.datastore.DataThunk)
+        self.assertIsNone(thunk._data)
+
+    def test_header(self):
+        key, objtype = self.ds['formatting'].header('templates.json')
+        self.assertEqual((key, objtype), ('templates', 'entity'))
+
+    def test_evaluate(self):
+        eager = archon.datastore.GameDatastore('data')
+        self.assertEqual(
+            self.ds['formatting.templates'].attributes.attributes,
+            eager['formatting.templates'].attributes.attributes)
+
+
+class TestPathResolution(unittest.TestCase):
+    def setUp(self):
+        self.ds = archon.datastore.GameDatastore('data', lazy=True)
+
+    def test_lookup(self):
+        formatting = self.ds['formatting']
+        for key in ('formatting.templates', 'data.formatting.templates',
+                    '.formatting.templates'):
+            self.assertEqual(self.ds.datastoreFor(key),
+                             ('templates', formatting))
+            self.assertIn(key, self.ds)
+            self.assertEqual(self.ds.fullPathFor(key),
+                             'data.formatting.templates')
+        self.assertNotIn('formatting.missing', self.ds)
+        self.assertNotIn('missing.templates', self.ds)
+
+    def test_cacheBounded(self):
+        formatting = self.ds['formatting']
+        for i in range(100):
+            key = 'key{}'.format(i)
+            self.assertEqual(self.ds.datastoreFor('formatting.' + key),
+                             (key, formatting))
+        self.assertEqual(len(self.ds._resolved), 1)
+
+    def test_invalidate(self):
+        self.assertNotIn('formatting.templates.x', self.ds)
+        other = archon.datastore.GameDatastore('data', self.ds['formatting'])
+        self.ds['formatting'].add('templates', other)
+        self.assertEqual(self.ds.datastoreFor('formatting.templates.x'),
+                         ('x', other))
+        self.ds['formatting'].remove('templates')
+        self.assertRaises(KeyError, self.ds.datastoreFor,
+                          'formatting.templates.x')
+
+    def test_reparent(self):
+        formatting = self.ds['formatting']
+        self.assertEqual(formatting.fullName, 'data.formatting')
+        other = archon.datastore.GameDatastore('data')
+        formatting.parent = other
+        self.assertEqual(formatting.fullName, 'data.formatting')
+        formatting.parent = None
+        self.assertEqual(formatting.fullName, 'formatting')
+        self.assertIs(formatting.root, formatting)
+
+
+class TestKeyAllocation(unittest.TestCase):
+    def test_new_key(self):
+        ds = archon.datastore.GameDatastore('data')
+        self.assertEqual([ds.newKey() for _ in range(3)], ['0', '1', '2'])
+        ds.add('7', {})
+        self.assertEqual(ds.newKey(), '8')
+        ds.remove('7')
+        ds.add('3', {})
+        self.assertEqual(ds.newKey(), '9')
+        ds.reserveKeys(20)
+        self.assertEqual(ds.keyCounter, 20)
+        ds.reserveKeys(5)
+        self.assertEqual(ds.newKey(), '20')
+
+
+class TestCompaction(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        helpers.restoreHooks(self)
+
+        class CompactHook(archon.entity.MutableEntityHook):
+            KIND = 'compacttest'
+
+        self.ds = archon.datastore.GameDatastore(self.dir)
+        self.previous = archon.entity.Entity.instances
+        archon.entity.Entity.instances = self.ds
+        self.proto = archon.entity.Entity('proto', 'compacttest', self.ds,
+                                          {'health': 10})
+
+    def tearDown(self):
+        archon.entity.Entity.instances = self.previous
+
+    def test_compact(self):
+        clean = self.proto.copy()
+        changed = self.proto.copy()
+        changed.attributes['health'] = 5
+        held = self.proto.copy()
+        report = self.ds.compact()
+        self.assertEqual((report['weakened'], report['weak']), (2, 2))
+        instances = self.ds['compacttest']
+        self.assertIs(instances[held.name], held)
+        del clean
+        gc.collect()
+        self.assertEqual(sorted(instances.keys()), ['1', '2'])
+        held.attributes['health'] = 1
+        report = self.ds.compact()
+        self.assertEqual((report['pinned'], report['reclaimed']), (1, 1))
+        del held, changed
+        gc.collect()
+        self.assertEqual(sorted(key for key, _ in instances.items()),
+                         ['1', '2'])
+
+
+class TestParallelScan(unittest.TestCase):
+    def keys(self, ds):
+        return {key: self.keys(item) if hasattr(item, 'thunks') else None
+                for key, item in ds.thunks.items()}
+
+    def test_same_tree(self):
+        serial = archon.datastore.GameDatastore('data')
+        for lazy in (False, True):
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                parallel = archon.datastore.GameDatastore(
+                    'data', lazy=lazy, executor=executor)
+            self.assertEqual(self.keys(parallel), self.keys(serial))
+            self.assertEqual(
+                parallel['formatting.templates'].attributes.attributes,
+                serial['formatting.templates'].attributes.attributes)
+
+
+class TestEviction(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('a', 'b', 'c'):
+            self.write(name, 'data', {'name': name})
+        self.ds = archon.datastore.GameDatastore(self.dir, maxLoaded=2)
+
+    def loaded(self):
+        return {key for key, item in self.ds.thunks.items()
+                if not isinstance(item, archon.datastore.DataThunk)}
+
+    def test_lru(self):
+        self.ds['a'], self.ds['b'], self.ds['a'], self.ds['c']
+        self.assertEqual(self.loaded(), {'a', 'c'})
+        self.assertEqual(self.ds['b'], {'name': 'b'})
+        self.assertEqual(self.ds.statistics,
+                         {'hits': 1, 'misses': 4, 'evictions': 2})
+
+    def test_pinned(self):
+        self.ds['a']
+        self.ds.save('a')
+        self.ds['b'], self.ds['c']
+        self.assertEqual(self.loaded(), {'a', 'b', 'c'})
+
+    def test_script(self):
+        with open(os.path.join(self.dir, 'evicted.py'), 'w') as f:
+            f.write("@command('evictiontest')\n"
+                    "def evictiontest(output, context, player):\n"
+                    "    pass\n")
+        self.addCleanup(archon.commands.command.functions.pop,
+                        'evictiontest', None)
+        ds = archon.datastore.GameDatastore(self.dir, maxLoaded=1)
+        script = ds['evicted']
+        ds['a'], ds['b']
+        self.assertIs(ds['evicted'], script)
+        self.assertIn('evictiontest', archon.commands.command.functions)
+
+
+class TestSharing(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write('a', 'data', {'value': 1})
+        self.write('attack', 'entity', {'kind': 'item', 'attributes': {
+                    'damage': 2}})
+        self.write('sword', 'entity', {'kind': 'item', 'attributes': {
+                    'effect': {'template': 'attack', 'data': {
+                            'damage': 3}}}})
+        self.write('you', 'entity', {'kind': 'player', 'attributes': {
+                    'equip': {}, 'inventory': {}}})
+
+    def test_shared(self):
+        first = archon.datastore.GameDatastore(self.dir, shared=True)
+        second = archon.datastore.GameDatastore(self.dir, lazy=True,
+                                                shared=True)
+        self.assertIsNot(first['a'], second['a'])  # data may be changed
+        self.assertIs(first['sword'], second['sword'])
+        self.assertIs(second['sword'].attributes['effect'].prototype,
+                      first['attack'])
+        self.assertIsNot(first['you'], second['you'])
+
+    def test_unshared(self):
+        first = archon.datastore.GameDatastore(self.dir, shared=True)
+        second = archon.datastore.GameDatastore(self.dir)
+        self.assertIsNot(first['sword'], second['sword'])
+        self.assertIs(second['sword'].entityCache, second)
+
+    def test_changed(self):
+        first = archon.datastore.GameDatastore(self.dir, shared=True)
+        self.write('attack', 'entity', {'kind': 'item', 'attributes': {
+                    'damage': 1}})
+        second = archon.datastore.GameDatastore(self.dir, shared=True)
+        self.assertIsNot(first['attack'], second['attack'])
+        # the same data, but templated on a different entity
+        self.assertIsNot(first['sword'], second['sword'])
+        self.assertEqual(second['sword'].attributes['effect'].attributes[
+                'damage'], 3)
+
+
+class TestWatcher(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        helpers.restoreHooks(self)
+
+        class WatchHook(archon.entity.EntityHook):
+            KIND = 'watchtest'
+            templates = {}
+
+        self.WatchHook = WatchHook
+        self.write('a', 'data', {'value': 1})
+        self.write('t', 'entity', {'kind': 'watchtest', 'attributes': {}})
+        self.ds = archon.datastore.GameDatastore(self.dir, lazy=True)
+        self.watcher = self.ds.watch()
+
+    def test_changed(self):
+        self.assertEqual(self.ds['a'], {'value': 1})
+        unloaded = self.ds.thunkFor('t')
+        self.write('a', 'data', {'value': 2})
+        self.assertEqual(self.watcher.poll(force=True),
+                         [self.ds.name + '.a'])
+        self.assertEqual(self.ds['a'], {'value': 2})
+        self.assertIs(self.ds.thunkFor('t'), unloaded)
+        self.assertEqual(self.watcher.poll(force=True), [])
+
+    def test_added_removed(self):
+        os.remove(os.path.join(self.dir, 'a.json'))
+        self.write('b', 'data', {})
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self.write('c', 'data', {}, os.path.join(self.dir, 'sub'))
+        self.assertEqual(sorted(self.watcher.poll(force=True)),
+                         [self.ds.name + suffix
+                          for suffix in ('.a', '.b', '.sub')])
+        self.assertNotIn('a', self.ds)
+        self.assertEqual(self.ds['b'], {})
+        self.assertEqual(self.ds['sub.c'], {})
+
+    def test_templates(self):
+        template = self.ds['t']
+        self.WatchHook.templates = {'default': template}
+        received = []
+        self.ds.onReload.connect(
+            lambda sender, **kwargs: received.append(sender), weak=False)
+        self.write('t', 'entity', {'kind': 'watchtest',
+                                   'attributes': {'x': 1}})
+        self.watcher.poll(force=True)
+        self.assertIs(received[-1], template)
+        self.assertEqual(self.WatchHook.templates['default'].attributes['x'],
+                         1)
+
+    def test_room(self):
+        for name in ('third_person_neutral', 'hostile'):
+            self.write(name, 'entity', {'kind': 'messages', 'attributes': {}})
+        square = {'describe': 'A square.', 'attributes': {}, 'outputs': {},
+                  'contents': {'guard, a': {'entity': 'guard'},
+                               'guard, another': {'entity': 'guard'}}}
+        self.write('square', 'room', square)
+        self.watcher.poll(force=True)
+        thunk = self.ds.thunkFor('square')
+        thunk.data = archon.common.Merge(thunk.data, patch={'update': {
+                    'data': {'update': {'contents': {
+                                'delete': ['guard, a']}}}}}).patched()
+        room = self.ds['square']
+        room.attributes['lit'] = True
+        square['describe'] = 'A busy square.'
+        # an entity not changed in play takes the edit
+        square['contents']['guard, another']['messages'] = 'hostile'
+        self.write('square', 'room', square)
+        self.watcher.poll(force=True)
+        self.assertIs(self.ds['square'], room)
+        self.assertEqual([key.save() for key in room.contents],
+                         ['guard, another'])
+        data, = room.contents.values()
+        self.assertIs(data.messages, self.ds['hostile'])
+        self.assertTrue(room.attributes['lit'])
+        self.assertEqual(room.save()['data']['describe'], 'A busy square.')
+        self.assertIsNotNone(room.diff())
+
+
+class TestSaveQueue(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.dir, 'a.json')
+
+    def test_coalesced(self):
+        queue = archon.datastore.SaveQueue()
+        with queue._condition:  # hold the writer back
+            first = queue.put(self.path, 'first')
+            second = queue.put(self.path, 'second')
+        self.assertEqual(first.result(), self.path)
+        self.assertEqual(second.result(), self.path)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'second')
+        self.assertEqual(os.listdir(self.dir), ['a.json'])
+
+    def test_datastore(self):
+        ds = archon.datastore.GameDatastore(self.dir)
+        future = ds.save('a', {'type': 'data', 'data': {}}, immediately=True)
+        ds.flush()
+        self.assertTrue(future.done())
+        self.assertEqual(ds.raw('a.json')[1], {'type': 'data', 'data': {}})
+
+    def game(self):
+        self.addCleanup(archon.commands.pendingSaves.clear)
+        ds = archon.datastore.GameDatastore(self.dir)
+        ds.create('instances')
+        player = archon.entity.Entity(
+            'player', 'savetest', ds, archon.entity.MutableEntityHook(
+                None, {}))
+        player.attributes.entity = player
+        return ds, player, archon.objects.Room('square', '', ds)
+
+    def test_command(self):
+        class Output(archon.interface.Interface):
+            def display(self, text, *kwargs):
+                displayed.append(text)
+
+        displayed = []
+        ds, player, room = self.game()
+        # the writer cannot replace the files with their temporary copies
+        for name in ('player', 'patches'):
+            os.mkdir(os.path.join(self.dir, name + '.json.tmp'))
+        archon.commands.save(Output(), room, player)
+        self.assertTrue(displayed[-1].startswith('Save game created'))
+        ds.flush()
+        self.assertTrue(player.attributes.dirty)
+        for name in ('player', 'patches'):
+            os.rmdir(os.path.join(self.dir, name + '.json.tmp'))
+        # the next save reports the failure and writes the files again
+        archon.commands.save(Output(), room, player)
+        self.assertTrue(any(text.startswith('Could not save game')
+                            for text in displayed))
+        self.assertTrue(displayed[-1].startswith('Save game created'))
+        ds.flush()
+        self.assertFalse(player.attributes.dirty)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['gameVars.json', 'instances', 'patches.json',
+                          'player.json'])
+
+    def test_quit(self):
+        class Output(archon.interface.Interface):
+            def quit(self, message=''):
+                quitted.append(message)
+
+        quitted = []
+        _, player, room = self.game()
+        os.mkdir(os.path.join(self.dir, 'patches.json.tmp'))
+        archon.commands.save(Output(), room, player)
+        # quitting waits for the save and reports that it failed
+        with self.assertRaises(archon.interface.CommandExecutionError):
+            archon.commands.quit(Output(), room, player)
+        self.assertEqual(quitted, [])
+        archon.commands.quit(Output(), room, player)
+        self.assertEqual(quitted, [''])
+
+
+class TestSQLiteDatastore(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.filename = os.path.join(self.dir, 'data.db')
+        self.ds = archon.sqlitedatastore.importDirectory('data', self.filename)
+
+    def tearDown(self):
+        self.ds.close()
+
+    def test_import(self):
+        eager = archon.datastore.GameDatastore('data')
+        self.assertEqual(self.ds.name, 'data')
+        self.assertEqual(
+            self.ds['formatting.templates'].attributes.attributes,
+            eager['formatting.templates'].attributes.attributes)
+        self.assertEqual(self.ds['formatting'].fullName, 'data.formatting')
+
+    def test_save(self):
+        child = self.ds.create('save')
+        child.save('vars', {'type': 'data', 'data': {'a': 1}},
+                   immediately=True)
+        self.ds.close()
+        self.ds = archon.sqlitedatastore.SQLiteDatastore(self.filename)
+        self.assertEqual(self.ds['save.vars'], {'a': 1})
+        self.assertEqual(self.ds['save'].raw('vars', '.json')[1],
+                         {'type': 'data', 'data': {'a': 1}})
+
+    def test_export(self):
+        path = os.path.join(self.dir, 'data')
+        archon.sqlitedatastore.exportDirectory(self.filename, path)
+        ds = archon.datastore.GameDatastore(path)
+        self.assertEqual(ds['formatting'].raw('templates.json'),
+                         self.ds['formatting'].raw('templates.json'))
+
+
+class DatastoreContract:
+    """Tests that every writable datastore backend passes.
+
+    Subclasses implement :meth:`open`, returning the root of a tree with
+    the contents of :attr:`path`."""
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.dir, 'data')
+        os.mkdir(self.path)
+        for name in ('a', 'b', 'c'):
+            self.write(name, 'data', {'name': name}, self.path)
+        self.ds = self.open(maxLoaded=2)
+
+    def test_lookup(self):
+        self.assertEqual(self.ds['a'], {'name': 'a'})
+        self.assertEqual(self.ds.datastoreFor('data.a'), ('a', self.ds))
+        self.assertNotIn('missing', self.ds)
+        self.assertFalse(self.ds.shared)
+        self.assertTrue(self.open(shared=True).shared)
+
+    def test_eviction(self):
+        self.ds['a'], self.ds['b'], self.ds['a'], self.ds['c']
+        self.assertEqual(self.ds['b'], {'name': 'b'})
+        self.assertEqual(self.ds.statistics,
+                         {'hits': 1, 'misses': 4, 'evictions': 2})
+
+    def test_save(self):
+        child = self.ds.create('save')
+        future = child.save('vars', {'type': 'data', 'data': {'a': 1}},
+                            immediately=True)
+        future.result()
+        self.assertEqual(self.open()['save.vars'], {'a': 1})
+
+    def test_saveNothing(self):
+        self.ds['a']
+        self.assertIsNone(self.ds.save('a', None, immediately=True).result())
+        self.assertEqual(self.open()['a'], {'name': 'a'})
+
+
+class TestGameDatastoreContract(DatastoreContract, helpers.TempDirTestCase):
+    def open(self, **kwargs):
+        return archon.datastore.GameDatastore(self.path, **kwargs)
+
+
+class TestSQLiteDatastoreContract(DatastoreContract,
+                                  helpers.TempDirTestCase):
+    def open(self, **kwargs):
+        filename = os.path.join(self.dir, 'data.db')
+        if not os.path.exists(filename):
+            archon.sqlitedatastore.importDirectory(
+                self.path, filename).close()
+        ds = archon.sqlitedatastore.SQLiteDatastore(filename, **kwargs)
+        self.addCleanup(ds.close)
+        return ds
+
+
+class TestArchive(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.filename = os.path.join(self.dir, 'data.archive')
+        archon.archive.pack('data', self.filename)
+        self.ds = archon.archive.ArchiveDatastore(self.filename)
+
+    def tearDown(self):
+        self.ds.close()
+
+    def test_read(self):
+        eager = archon.datastore.GameDatastore('data')
+        self.assertEqual(self.ds.name, 'data')
+        self.assertEqual(self.ds['formatting'].header('templates.json'),
+                         ('templates', 'entity'))
+        self.assertEqual(
+            self.ds['formatting.templates'].attributes.attributes,
+            eager['formatting.templates'].attributes.attributes)
+
+    def test_read_only(self):
+        self.assertRaises(IOError, self.ds.create, 'save')
+        self.assertRaises(IOError, self.ds.save, 'a', {}, immediately=True)
+
+    def test_mount(self):
+        os.mkdir(os.path.join(self.dir, 'save'))
+        save = archon.datastore.GameDatastore(
+            os.path.join(self.dir, 'save'), self.ds)
+        self.ds.add('save', save)
+        self.ds['save'].create('player')
+        self.assertEqual(self.ds['save.player'].fullName, 'data.save.player')
+
+
+class TestManifest(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.dir, 'data')
+        self.manifest = os.path.join(self.dir, 'manifest')
+        shutil.copytree('data', self.path)
+
+    def readManifest(self):
+        with open(self.manifest) as f:
+            return json.load(f)
+
+    def test_written(self):
+        ds = archon.datastore.GameDatastore(self.path, manifest=self.manifest)
+        entries = {key: entry for key, path, entry in ds.manifestEntries()}
+        self.assertEqual(entries['formatting.templates']['type'], 'entity')
+        root = self.readManifest()['root']
+        self.assertIn('templates.json',
+                      root['directories']['formatting']['files'])
+
+    def test_trusted(self):
+        archon.datastore.GameDatastore(self.path, manifest=self.manifest)
+        manifest = self.readManifest()
+        files = manifest['root']['directories']['formatting']['files']
+        files['templates.json']['type'] = 'data'
+        with open(self.manifest, 'w') as f:
+            json.dump(manifest, f)
+        ds = archon.datastore.GameDatastore(self.path, manifest=self.manifest)
+        self.assertEqual(
+            ds['formatting']._manifestFiles['templates.json']['type'], 'data')
+
+    def test_invalidated(self):
+        archon.datastore.GameDatastore(self.path, manifest=self.manifest)
+        self.write('new', 'data', {'a': 1},
+                   os.path.join(self.path, 'formatting'))
+        ds = archon.datastore.GameDatastore(self.path, manifest=self.manifest)
+        self.assertEqual(ds['formatting.new'], {'a': 1})
+        self.assertIn('new.json', self.readManifest()['root']['directories']
+                      ['formatting']['files'])
+
+if __name__ == '__main__':
+    unittest.main()
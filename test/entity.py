@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+import gc
+import os
+import unittest
+import warnings
+import weakref
+
+import archon
+import archon.common
+import archon.datahandlers
+import archon.datastore
+import archon.entity
+import archon.objects
+
+import helpers
+
+
+class TestHookRegistry(unittest.TestCase):
+    def test_registered(self):
+        EntityHook = archon.entity.EntityHook
+        self.assertIs(EntityHook.getHook('player'),
+                      archon.objects.PlayerEntityHook)
+        self.assertIs(archon.entity.MutableEntityHook.getHook('room'),
+                      archon.objects.RoomEntityHook)
+        self.assertRaises(archon.entity.EntityHookNotFoundError,
+                          archon.objects.RoomEntityHook.getHook, 'player')
+        self.assertRaises(archon.entity.EntityHookNotFoundError,
+                          EntityHook.getHook, 'nonexistent')
+
+    def setUp(self):
+        helpers.restoreHooks(self)
+
+    def test_later(self):
+        class LaterEntityHook(archon.entity.EntityHook):
+            KIND = 'registrytest'
+
+        class InheritingEntityHook(LaterEntityHook):
+            pass
+
+        self.assertIs(archon.entity.EntityHook.getHook('registrytest'),
+                      LaterEntityHook)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+
+            class ConflictingEntityHook(archon.entity.EntityHook):
+                KIND = 'registrytest'
+
+        self.assertEqual(len(caught), 1)
+        self.assertIs(archon.entity.EntityHook.getHook('registrytest'),
+                      LaterEntityHook)
+
+    def test_reloaded(self):
+        def define():
+            class ReloadedEntityHook(archon.entity.EntityHook):
+                KIND = 'registrytest'
+            return ReloadedEntityHook
+
+        old = define()
+        old.templates = {'default': None}
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            new = define()
+        self.assertIs(archon.entity.EntityHook.getHook('registrytest'), new)
+        self.assertIs(new.templates, old.templates)
+
+
+class TestCachedNames(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.dir, 'data', 'items'))
+        os.makedirs(os.path.join(self.dir, 'resources'))
+        self.ds = archon.datastore.GameDatastore(
+            os.path.join(self.dir, 'data'))
+        self.sword = archon.entity.Entity(
+            'sword', 'item', self.ds['items'],
+            archon.entity.MutableEntityHook(None, {}))
+        self.sword.attributes.entity = self.sword
+        self.ds['items'].add('sword', self.sword)
+
+    def test_location(self):
+        self.assertEqual(self.sword.location, 'data.items.sword')
+        self.assertIs(self.sword.location, self.sword.location)
+        self.sword.name = 'blade'
+        self.assertEqual(self.sword.location, 'data.items.blade')
+        self.ds['items'].parent = archon.datastore.GameDatastore(
+            os.path.join(self.dir, 'resources'))
+        self.assertEqual(self.sword.location, 'resources.items.blade')
+
+    def test_friendlyName(self):
+        self.assertEqual(self.sword.friendlyName, 'sword')
+        self.sword.name = 'blade'
+        self.assertEqual(self.sword.friendlyName, 'blade')
+        self.sword.attributes['friendlyName'] = 'Rusty Sword'
+        self.assertEqual(self.sword.friendlyName, 'Rusty Sword')
+
+
+class TestSpawn(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        helpers.restoreHooks(self)
+
+        class SpawnHook(archon.entity.MutableEntityHook):
+            __slots__ = ()
+            KIND = 'spawntest'
+
+        self.SpawnHook = SpawnHook
+        self.write('guard', 'entity', {'kind': 'spawntest',
+                                       'attributes': {'health': 5}})
+        self.ds = archon.datastore.GameDatastore(self.dir)
+        self.instances = self.ds.create('instances')
+        self.saved, archon.entity.Entity.instances = (
+            archon.entity.Entity.instances, self.instances)
+
+    def tearDown(self):
+        archon.entity.Entity.instances = self.saved
+
+    def test_spawn(self):
+        guard = self.ds['guard']
+        first = guard.copy()
+        spawned = guard.spawn(3)
+        self.assertEqual([entity.name for entity in spawned],
+                         ['1', '2', '3'])
+        self.assertEqual(set(self.instances['spawntest'].keys()),
+                         {'0', '1', '2', '3'})
+        for entity in spawned:
+            self.assertIs(entity.prototype, guard)
+            self.assertIsInstance(entity.attributes, self.SpawnHook)
+            self.assertIs(entity.attributes.entity, entity)
+        spawned[0].attributes['health'] = 1
+        self.assertEqual(spawned[1].attributes['health'], 5)
+        self.assertEqual(guard.copy().name, '4')
+
+    def test_saved(self):
+        guard = self.ds['guard']
+        first = guard.copy()
+        first.attributes['health'] = 4
+        patch = first.attributes.diff(guard)
+        # load the instance as a save game would, then save it again
+        archon.datahandlers.metadata('patches', {'savegame_instances': {
+                    guard.location: {'7': patch}}}, self.ds)
+        loaded = self.instances['spawntest']['7']
+        self.assertEqual(loaded.attributes['health'], 4)
+        self.assertFalse(loaded.attributes.dirty)
+        self.assertEqual(loaded.attributes.diff(guard), patch)
+
+    def test_room(self):
+        room = archon.objects.Room('square', '', self.ds)
+        messages = archon.entity.Entity('messages', 'messages', self.ds)
+        keys = [archon.objects.EntityKey('guard', prefix)
+                for prefix in ('a', 'another')]
+        spawned = room.spawn('guard', keys, messages=messages)
+        self.assertEqual([room.entityFor(key) for key in keys], spawned)
+        self.assertEqual(room.naturalFind('another guard'), keys[1])
+        self.assertEqual(room.naturalFind('Guard'), set(keys))
+        self.assertIsNone(room.naturalFind('a'))
+        room.remove(keys[1])
+        self.assertEqual(room.naturalFind('guard'), keys[0])
+        self.assertIsNone(room.naturalFind('another guard'))
+        room.clearContents()
+        self.assertIsNone(room.naturalFind('guard'))
+
+    def test_removeUncopied(self):
+        room = archon.objects.Room('square', '', self.ds)
+        messages = archon.entity.Entity('messages', 'messages', self.ds)
+        key = archon.objects.EntityKey('guard', 'a')
+        room.add('guard', key, messages=messages)
+        room.attributes.markClean()
+        room.remove(key)
+        self.assertNotIn(key, room.contents)
+        self.assertIsNone(room.naturalFind('guard'))
+        self.assertTrue(room.dirty)
+
+
+class TestChanges(unittest.TestCase):
+    def setUp(self):
+        self.changes = []
+        self.guard = archon.entity.Entity(
+            '0', 'guard', None, archon.entity.MutableEntityHook(
+                None, archon.common.CopyOnWriteDict({
+                        'vitals': {'health': 10}, 'name': 'guard'})))
+        self.guard.attributes.entity = self.guard
+        self.room = archon.entity.Entity(
+            'room', 'guard', None,
+            archon.entity.MutableEntityHook(None, {'vitals': {}}))
+        self.room.attributes.entity = self.room
+
+    def tearDown(self):
+        archon.entity.MutableEntityHook.onChange.disconnect(self.receiver)
+
+    def connect(self, *args):
+        self.receiver = archon.entity.MutableEntityHook.connectChanges(
+            self.record, *args)
+
+    def record(self, entity, **change):
+        self.changes.append((entity, change['path'], change['value'],
+                             change['deleted']))
+
+    def test_changes(self):
+        self.connect()
+        self.guard.attributes['name'] = 'captain'
+        self.guard.attributes['vitals']['health'] -= 3
+        del self.guard.attributes['name']
+        self.room.attributes['time'] = 1
+        self.room.attributes['vitals']['health'] = 2
+        self.room.attributes.markDirty('vitals')
+        self.assertEqual(self.changes, [
+                (self.guard, ('name',), 'captain', False),
+                (self.guard, ('vitals', 'health'), 7, False),
+                (self.guard, ('name',), None, True),
+                (self.room, ('time',), 1, False),
+                (self.room, ('vitals',), {'health': 2}, False)])
+
+    def test_filtered(self):
+        self.connect(self.guard, 'vitals')
+        self.guard.attributes['name'] = 'captain'
+        self.guard.attributes['vitals']['health'] = 1
+        self.room.attributes['vitals'] = {}
+        self.assertEqual(self.changes, [
+                (self.guard, ('vitals', 'health'), 1, False)])
+
+    def test_lambda(self):
+        receiver = weakref.ref(archon.entity.MutableEntityHook.connectChanges(
+            lambda entity, **change: self.changes.append(change['path'])))
+        gc.collect()
+        self.receiver = receiver()
+        self.assertIsNotNone(self.receiver)
+        self.guard.attributes['vitals']['health'] = 1
+        self.assertEqual(self.changes, [('vitals', 'health')])
+
+    def test_invalidates(self):
+        class TitledHook(archon.entity.MutableEntityHook):
+            __slots__ = ()
+
+            @property
+            def friendlyName(self):
+                return self['title']['name']
+
+        self.receiver = self.record
+        guard = archon.entity.Entity('0', 'guard', None, TitledHook(
+                None, archon.common.CopyOnWriteDict({
+                        'title': {'name': 'the guard'}})))
+        guard.attributes.entity = guard
+        self.assertEqual(guard.friendlyName, 'the guard')
+        guard.attributes['title']['name'] = 'the captain'
+        self.assertEqual(guard.friendlyName, 'the captain')
+
+    def test_nestedSaved(self):
+        self.receiver = self.record
+        proto = archon.entity.Entity(
+            'guard', 'guard', None, archon.entity.MutableEntityHook(
+                None, {'vitals': {'health': 10}, 'name': 'guard'}))
+        guard = archon.entity.Entity(
+            '0', 'guard', None, archon.entity.MutableEntityHook(
+                None, proto.attributes.copy()), prototype=proto)
+        self.assertFalse(guard.attributes.diff(proto))
+        guard.attributes['vitals']['health'] = 3
+        self.assertTrue(guard.attributes.dirty)
+        patch = guard.attributes.diff(proto)
+        self.assertFalse(guard.attributes.dirty)
+        loaded = proto.attributes.copy()
+        loaded.applyPatch(patch)
+        self.assertEqual(loaded['vitals']['health'], 3)
+        guard.attributes['vitals']['health'] = 5
+        loaded = proto.attributes.copy()
+        loaded.applyPatch(guard.attributes.diff(proto))
+        self.assertEqual(loaded['vitals']['health'], 5)
+
+
+class TestDerivedStats(unittest.TestCase):
+    def setUp(self):
+        self.saved = archon.objects.PlayerEntityHook.templates
+        archon.objects.PlayerEntityHook.templates = {
+            'default': self.template(['increasing', 0, 0])}
+        self.player = archon.entity.Entity('you', 'player', None, {
+                'equip': {}, 'inventory': {},
+                'acumen': {'physical': 50, 'mental': 100},
+                'maxVitals': {'health': [1, 2]}})
+
+    def tearDown(self):
+        archon.objects.PlayerEntityHook.templates = self.saved
+
+    def template(self, success):
+        return archon.entity.Entity('template_player', 'template', None, {
+                'stats': {'template': {'success': success}}})
+
+    def test_cached(self):
+        attributes = self.player.attributes
+        stats = attributes.stats
+        self.assertIs(attributes.stats, stats)
+        self.assertEqual(attributes.maxVitals, {'health': 250})
+        self.assertEqual(attributes.level, 1)
+        attributes.acumen['physical'] = 150
+        self.assertIsNot(attributes.stats, stats)
+        self.assertGreater(attributes.stats['physical']['success'][0],
+                           stats['physical']['success'][0])
+        self.assertEqual(attributes.maxVitals, {'health': 400})
+        self.assertEqual(attributes.level, 2)
+        stats = attributes.stats
+        archon.objects.PlayerEntityHook.templates = {
+            'default': self.template(['increasing', 1, 1])}
+        self.assertEqual(attributes.stats['physical']['success'][0],
+                         stats['physical']['success'][0] + 1)
+
+    def test_changed(self):
+        attributes = self.player.attributes
+        stats = attributes.stats
+        self.assertEqual(attributes.maxVitals, {'health': 250})
+        attributes['maxVitals']['health'] = [2, 2]
+        attributes.markDirty('vitals')
+        self.assertIs(attributes.stats, stats)
+        attributes.markDirty()
+        self.assertEqual(attributes.maxVitals, {'health': 300})
+        copy = self.player.copy(instanced=False)
+        self.assertEqual(copy.attributes.maxVitals, {'health': 300})
+        copy.attributes['maxVitals']['health'] = [1, 1]
+        self.assertEqual(copy.attributes.maxVitals, {'health': 150})
+        self.assertEqual(attributes.maxVitals, {'health': 300})
+
+
+class TestInventory(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, friendlyName in (('sword', 'Iron Sword'),
+                                   ('potion', 'Potion')):
+            self.write(name, 'entity', {'kind': 'item', 'attributes': {
+                        'friendlyName': friendlyName}})
+        self.ds = archon.datastore.GameDatastore(self.dir)
+        self.inventory = archon.objects.InventoryProxy({'potion': 2},
+                                                       self.ds)
+
+    def test_find(self):
+        sword = self.ds['sword']
+        self.assertEqual(len(self.inventory), 2)
+        self.assertIs(self.inventory.find('potion'), self.ds['potion'])
+        self.assertRaises(KeyError, self.inventory.find, 'iron', 'sword')
+        self.inventory.add(sword)
+        self.assertIs(self.inventory.find('iron', 'SWORD'), sword)
+        self.assertIs(self.inventory.find(sword.location), sword)
+        self.assertEqual(len(self.inventory), 3)
+        self.inventory.remove(sword)
+        self.assertRaises(KeyError, self.inventory.find, 'iron', 'sword')
+        self.inventory.remove('potion')
+        self.assertEqual(len(self.inventory), 1)
+        self.assertEqual(self.inventory.save(),
+                         {self.ds['potion'].location: 1})
+
+    def test_mutable(self):
+        first, second = (archon.entity.Entity(
+                name, 'item', self.ds,
+                archon.entity.MutableEntityHook(None, {
+                        'friendlyName': 'Chest'})) for name in 'ab')
+        self.inventory.add(first)
+        self.inventory.add(second)
+        self.inventory.add(first)
+        self.assertEqual(len(self.inventory), 4)
+        self.inventory.remove(first)
+        self.assertEqual(len(self.inventory), 3)
+        self.assertEqual(self.inventory.save()[second.location],
+                         [second.location])
+
+    def test_removeUnheld(self):
+        first, second = (archon.entity.Entity(
+                'a', 'item', self.ds,
+                archon.entity.MutableEntityHook(None, {
+                        'friendlyName': 'Chest'})) for _ in range(2))
+        self.inventory.add(first)
+        self.assertRaises(KeyError, self.inventory.remove, second)
+        self.assertEqual(len(self.inventory), 3)
+        self.inventory.remove(first)
+        self.assertRaises(KeyError, self.inventory.remove, first)
+        self.assertEqual(len(self.inventory), 2)
+
+
+class TestRoomDescriptions(unittest.TestCase):
+    def setUp(self):
+        helpers.restoreHooks(self)
+
+        class CountingHook(archon.entity.EntityHook):
+            __slots__ = ()
+            KIND = 'descriptiontest'
+            calls = 0
+
+            def message(self, name, entityData):
+                CountingHook.calls += 1
+                return 'There is {}.'.format(entityData.key)
+
+        self.CountingHook = CountingHook
+        self.room = archon.objects.Room('square', 'a square.', None)
+        self.messages = archon.entity.Entity('messages', 'descriptiontest',
+                                             None)
+        self.room.add('guard', archon.objects.EntityKey('guard', 'a'),
+                      messages=self.messages)
+
+    def test_cached(self):
+        text = 'You are in a square.\nThere is a guard.\nAdjoining areas: '
+        self.assertEqual(self.room.describe(), text)
+        self.assertIs(self.room.describe(), self.room.describe())
+        self.assertEqual(self.CountingHook.calls, 1)
+        self.room.add('woman', archon.objects.EntityKey('woman', 'a'),
+                      messages=self.messages)
+        self.assertIn('There is a woman.', self.room.describe())
+        self.assertEqual(self.CountingHook.calls, 3)
+        archon.objects.Room.descriptionGeneration += 1
+        self.room.describe()
+        self.assertEqual(self.CountingHook.calls, 5)
+        self.room.clearContents()
+        self.assertEqual(self.room.describe(),
+                         'You are in a square.\nAdjoining areas: ')
+
+
+class TestReloadedMessages(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        helpers.restoreHooks(self)
+
+        class MessagesHook(archon.entity.EntityHook):
+            __slots__ = ()
+            KIND = 'reloadtest'
+
+            def message(self, name, entityData):
+                return self[name].format(entityData.key)
+
+        self.write('messages', 'entity', {
+                'kind': 'reloadtest',
+                'attributes': {'summary': 'There is {}.'}})
+        self.ds = archon.datastore.GameDatastore(self.dir, lazy=True)
+        self.watcher = self.ds.watch()
+        self.room = archon.objects.Room('square', 'a square.', self.ds)
+        self.room.add('guard', archon.objects.EntityKey('guard', 'a'),
+                      messages='messages')
+
+    def test_reloaded(self):
+        self.assertIn('There is a guard.', self.room.describe())
+        self.write('messages', 'entity', {
+                'kind': 'reloadtest',
+                'attributes': {'summary': 'You see {}.'}})
+        self.watcher.poll(force=True)
+        self.assertIn('You see a guard.', self.room.describe())
+        data, = self.room.contents.values()
+        self.assertIs(data.messages, self.ds['messages'])
+
+
+class TestCopyOnWrite(unittest.TestCase):
+    def setUp(self):
+        self.base = {'vitals': {'health': 10, 'ap': 5}, 'name': 'guard',
+                     'options': ['talk'], 'equip': {'head': None}}
+        self.copy = archon.common.CopyOnWriteDict(self.base)
+
+    def test_shares(self):
+        self.assertEqual(self.copy, self.base)
+        self.assertEqual(self.copy.patch(), {})
+        self.copy['options'].append('fight')
+        self.copy['vitals']['health'] -= 3
+        del self.copy['equip']['head']
+        self.copy['level'] = 2
+        self.assertEqual(self.base['vitals']['health'], 10)
+        self.assertEqual(self.base['options'], ['talk'])
+        self.assertIn('head', self.base['equip'])
+        self.assertNotIn('vitals', self.copy._changes)
+        self.assertEqual(self.copy.materialize(), {
+                'vitals': {'health': 7, 'ap': 5}, 'name': 'guard',
+                'options': ['talk', 'fight'], 'equip': {}, 'level': 2})
+
+    def test_patch(self):
+        self.copy['vitals']['health'] = 1
+        self.copy['options']
+        del self.copy['name']
+        patch = self.copy.patch()
+        self.assertEqual(patch, archon.common.Merge(
+                self.base, self.copy.materialize()).compared())
+        other = archon.common.CopyOnWriteDict(self.base)
+        other.applyPatch(patch)
+        self.assertEqual(other, self.copy)
+        self.assertEqual(archon.common.Merge(self.base, patch=patch).patched(),
+                         self.copy.materialize())
+
+
+class TestTemplateChain(helpers.TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write('attack', 'entity', {'kind': 'object', 'attributes': {
+                    'message': 'hit', 'damage': {'magnitude': [0, 5],
+                                                 'drain': 2}}})
+        self.write('sword', 'entity', {'kind': 'object', 'attributes': {
+                    'describe': 'A sword.', 'value': 25,
+                    'effect': {'template': 'attack', 'data': {
+                            'damage': {'drain': 3}}}}})
+        self.write('dagger', 'entity', {'kind': 'object', 'attributes': {
+                    'effect': {'template': 'attack', 'data': {
+                            'damage': {'drain': 1}}}}})
+        self.write('iron_sword', 'entity', {
+                'kind': 'object', 'template': 'sword', 'attributes': {
+                    'value': 55, 'effect': {'data': {'damage': {
+                                'magnitude': [1, 6]}}}}})
+        self.ds = archon.datastore.GameDatastore(self.dir)
+
+    def test_embedded(self):
+        sword = self.ds['sword'].attributes['effect']
+        dagger = self.ds['dagger'].attributes['effect']
+        attack = self.ds['attack']
+        self.assertIs(sword.prototype, attack)
+        self.assertEqual(sword.attributes['damage']['drain'], 3)
+        self.assertEqual(dagger.attributes['damage']['drain'], 1)
+        self.assertEqual(sword.attributes['damage']['magnitude'], [0, 5])
+        self.assertEqual(attack.attributes['damage']['drain'], 2)
+        self.assertEqual(sword.attributes.attributes.patch(),
+                         {'update': {'damage': {'create': {'drain': 3}}}})
+
+    def test_template(self):
+        iron = self.ds['iron_sword']
+        self.assertEqual(iron.attributes['describe'], 'A sword.')
+        self.assertEqual(iron.attributes['value'], 55)
+        effect = iron.attributes['effect']
+        self.assertIs(effect.prototype,
+                      self.ds['sword'].attributes['effect'])
+        self.assertEqual(effect.attributes['damage']['magnitude'], [1, 6])
+        self.assertEqual(effect.attributes['damage']['drain'], 3)
+        self.assertEqual(effect.attributes['message'], 'hit')
+        effect.attributes.attributes.flatten()
+        self.assertEqual(effect.attributes['damage']['drain'], 3)
+        self.assertEqual(effect.attributes.attributes.patch(),
+                         {'update': {'damage': {'create': {
+                                 'magnitude': [1, 6]}}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
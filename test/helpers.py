@@ -0,0 +1,37 @@
+"""Fixtures shared by the tests."""
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+import archon.entity
+
+
+class TempDirTestCase(unittest.TestCase):
+    """A test case with a temporary directory, :attr:`dir`, removed after
+    each test."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, name, objtype, data, path=None):
+        """Write a game file of `objtype` to :attr:`dir`, or to `path`."""
+        fname = os.path.join(path or self.dir, name + '.json')
+        with open(fname, 'w') as f:
+            json.dump({'type': objtype, 'data': data}, f)
+        # make sure the change is visible with coarse timestamps
+        os.utime(fname, ns=(0, time.time_ns() + 10 ** 9))
+
+
+def restoreHooks(testCase):
+    """Restore the registered entity hooks after `testCase`, so that the
+    hooks it defines do not stay registered."""
+    hooks = archon.entity.EntityHook.hooks
+    saved = dict(hooks)
+
+    def restore():
+        hooks.clear()
+        hooks.update(saved)
+    testCase.addCleanup(restore)